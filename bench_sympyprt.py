@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+# =========================
+# sympyprt benchmark runner
+# =========================
+#
+# Usage:
+#   python bench_sympyprt.py [--backends latex,svg,...] [--modes cold,...]
+#                            [--json results.json] [--repeat n]
+#                            [--fake [seconds]] [--importbudget seconds]
+#
+# Renders the expressions of test_sympyprt.py (no IPython needed) through
+# every backend (method) and cache mode:
+#
+#   cold ...... all memory caches empty, no disk cache
+#   warm ...... the same expressions again (memory caches filled)
+#   disk ...... memory caches empty, disk cache filled by a previous pass
+#   batch ..... print_png_batch, one render thread
+#   parallel .. print_png_batch, fs.workers render threads
+#
+# and reports throughput, latency percentiles, peak RSS, output bytes and
+# the per-stage timings of sympyprt.Stats. Each scenario runs in a fresh
+# interpreter (--scenario), so its peak RSS is its own. With --json the results are
+# written as JSON (see result()) to compare versions. With --fake the TeX
+# programs are replaced by the stand-ins of fake_tex.py (optionally with a
+# latency per page), which leaves the Python overhead of the render path.
+# The import time of sympyprt (fresh interpreter) is measured as well; it
+# must not load a backend module (matplotlib, numpy, sympy, IPython) and
+# with --importbudget the exit status is 1 if it takes longer (see
+# test_sympyprt_import.py for the check alone).
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+from __future__ import division, print_function
+
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+from subprocess import Popen, PIPE
+
+try:
+  import resource
+except ImportError:
+  resource = None # NT
+
+if sys.version_info[0] >= 3:
+  import sympyprt3 as sp
+else:
+  import sympyprt as sp
+
+import sympy
+from sympy import *
+
+from test_sympyprt_import import importTime
+
+try:
+  Ylm
+except NameError:
+  Ylm = Ynm # newer sympy
+
+_backends = ['simple', 'mplib', 'latex', 'svg', 'auto']
+_modes = ['cold', 'warm', 'disk', 'batch', 'parallel']
+
+# Modes which need the latex/svg method (disk cache, print_png_batch)
+_latexmodes = ['disk', 'batch', 'parallel']
+
+
+#;;;;;;;;;;;;;
+# Corpus ;;;
+#;;;;;;;;;;;;;
+def corpus():
+  """
+  The expressions of test_sympyprt.py (in the same order).
+  """
+  Obj = []
+  _ = Obj.append
+
+  x, y, z, t = symbols('x y z t')
+  k, m, n = symbols('k m n', integer=True)
+  f, g, h = symbols('f g h', cls=Function)
+
+  _(x)
+  _(n)
+  _((1/cos(x)).series(x, 0, 10))
+  _(pi**2)
+  _(oo+1)
+  _(1/( (x+2)*(x+1) ))
+  _(diff(sin(x), x))
+  e = 1/(x + y)
+  _(e)
+  _(e.series(x, 0, 5))
+  _(integrate(exp(-x**2)*erf(x), x))
+  _(exp(I*x).expand(complex=True))
+
+  from sympy.abc import theta, phi
+  _(Ylm(2, 1, theta, phi))
+
+  _(factorial(x))
+  _(gamma(x + 1).series(x, 0, 3))
+  _(assoc_legendre(2, 1, x))
+  _(f(x).diff(x, x) + f(x))
+  _(dsolve(f(x).diff(x, x) + f(x), f(x)))
+
+  A = Matrix([[1,x], [y,1]])
+  _(A)
+  _(A**2)
+  _(Integral(x**2, x))
+  _(N(sqrt(2)*pi, 50))
+  _(Abs(-x))
+  _(binomial(x,y))
+  _(meijerg([1], [2], [3], [4], x))
+  _(integrate(x**2 * exp(x) * cos(x), x))
+  _(y | (x & y))
+  _(x >> y)
+  _(Matrix(3, 4, lambda i,j: 1 - (i+j) % 2))
+  M = Matrix(([1,2,3,4],[5,6,7,8],[9,10,11,12],[13,14,15,16]))
+  _(M)
+  _(M**4)
+
+  A = Matrix([[1,1,1],[1,1,3],[2,3,4]])
+  Q, R = A.QRdecomposition()
+  _(Q)
+  _(A)
+  _(R)
+
+  x, y, t, x0, y0, C1 = symbols('x,y,t,x0,y0,C1')
+  P, Q, F = map(Function, ['P', 'Q', 'F'])
+  _(Eq(Eq(F(x, y), Integral(P(t, y), (t, x0, x)) +
+          Integral(Q(x0, t), (t, y0, y))), C1))
+  # dsolve(2*x*f(x) + (x**2 + f(x)**2)*f(x).diff(x), f(x),
+  #        hint='1st_homogeneous_coeff_best') hangs on newer sympy, this
+  # is its solution (simplify=False)
+  _(Eq(log(f(x)), log(C1) - log(3*x**2/f(x)**2 + 1)/3))
+
+  n = Symbol('n')
+  f, P, Q = map(Function, ['f', 'P', 'Q'])
+  genform = Eq(f(x).diff(x) + P(x)*f(x), Q(x)*f(x)**n)
+  _(genform)
+  _(dsolve(genform, f(x), hint='Bernoulli_Integral'))
+
+  from sympy.tensor import IndexedBase, Idx
+  M = IndexedBase('M')
+  i, j = map(Idx, ['i', 'j'])
+  _(M[i, j])
+
+  _(x**n)
+  _((1/cos(x)).series(x, 0, 20))
+  _((1/cos(x)).series(x, 0, 21))
+  return Obj
+
+
+#;;;;;;;;;;;;;;;;
+# Measuring ;;;
+#;;;;;;;;;;;;;;;;
+def percentile(v, p):
+  """
+  The p-th percentile (nearest rank) of the sorted list v (None if empty).
+  """
+  if not v:
+    return None
+  return v[min(len(v) - 1, len(v) * p // 100)]
+
+def peakRSS():
+  """
+  Peak resident set size of this process in KiB (None if unknown).
+  """
+  if resource is None:
+    return None
+  r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return r // 1024 if sys.platform == 'darwin' else r
+
+def size(img):
+  return len(img) if img else 0
+
+def reset(disk = False):
+  """
+  Empty the memory caches of sympyprt (and the statistics), disk cache on
+  or off.
+  """
+  sp.clearCache()
+  sp.DviCache.clear()
+  sp.Stats.clear()
+  sp.gcfg.diskcache = disk
+
+
+def render(objs, backend, batch = False):
+  """
+  Render objs with the backend: one by one (latencies) or by
+  print_png_batch. Returns (latencies, total seconds, bytes, errors).
+  A backend raising an exception counts as an error.
+  """
+  show = sp.print_svg if backend == 'svg' else sp.print_png
+  lat, nbytes, errors = [], 0, 0
+  t0 = time.time()
+  if batch:
+    try:
+      imgs = sp.print_png_batch(objs)
+    except Exception:
+      imgs = [None] * len(objs)
+  else:
+    imgs = []
+    for x in objs:
+      t = time.time()
+      try:
+        imgs.append(show(x))
+      except Exception:
+        imgs.append(None)
+      lat.append(time.time() - t)
+  total = time.time() - t0
+  for img in imgs:
+    nbytes += size(img)
+    errors += not img
+  return sorted(lat), total, nbytes, errors
+
+
+def scenario(objs, backend, mode, workers):
+  """
+  Run one backend/mode combination, returns its result dict.
+  """
+  sp.gcfg._use = backend
+  sp.Renderer.resize(1 if mode == 'batch' else workers)
+  if mode == 'warm':
+    render(objs, backend)
+    sp.Stats.clear()
+  elif mode == 'disk':
+    reset(True)
+    render(objs, backend)
+    reset(True)
+  else:
+    reset()
+  lat, total, nbytes, errors = render(objs, backend,
+                                      mode in ('batch', 'parallel'))
+  sp.gcfg.diskcache = False
+  stages = dict(('%s/%s' % k, v) for k, v in sp.Stats.summary().items())
+  return {'backend': backend, 'mode': mode, 'n': len(objs),
+          'seconds': total, 'throughput': len(objs) / total if total else None,
+          'p50': percentile(lat, 50), 'p95': percentile(lat, 95),
+          'p99': percentile(lat, 99), 'bytes': nbytes, 'errors': errors,
+          'peakrss': peakRSS(), 'workers': sp.Renderer.n, 'stages': stages}
+
+
+def isolated(backend, mode, argv):
+  """
+  Run one scenario in a fresh interpreter (its own peak RSS) with the
+  options argv, returns its result dict (None if it failed).
+  """
+  path = os.path.abspath(__file__)
+  if path.endswith(('.pyc', '.pyo')):
+    path = path[:-1]
+  p = Popen([sys.executable, path, '--scenario', '%s:%s' % (backend, mode)]
+            + argv, stdout = PIPE, cwd = os.path.dirname(path))
+  out = p.communicate()[0].decode('utf-8').splitlines()
+  if p.returncode != 0 or not out:
+    return None
+  return json.loads(out[-1]) # after the error messages of the backends
+
+
+def result(runs, args, imp):
+  """
+  The machine readable result: {"meta": {...}, "import": {"seconds": t,
+  "modules": [backend modules loaded]}, "runs": [scenario, ...]}.
+  """
+  return {'import': {'seconds': imp[0], 'modules': imp[1]},
+          'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'sympy': sympy.__version__,
+                   'module': sp.__name__,
+                   'cpus': sp.cpu_count(),
+                   'repeat': args.repeat, 'fake': args.fake,
+                   'latex': sp.gcfg.latex, 'dvipng': sp.gcfg.dvipng},
+          'runs': runs}
+
+
+def report(runs):
+  """
+  Print the results as a table (milliseconds, KiB).
+  """
+  print("{:<7} {:<9} {:>4} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>5} {:>8}"
+        .format('method', 'mode', 'n', 'total s', 'expr/s', 'p50 ms',
+                'p95 ms', 'p99 ms', 'KiB', 'err', 'rss KiB'))
+  ms = lambda v: '' if v is None else '%.2f' % (1000 * v)
+  for r in runs:
+    print("{:<7} {:<9} {:>4} {:>8.3f} {:>8.1f} {:>8} {:>8} {:>8} {:>8.1f} "
+          "{:>5} {:>8}".format(r['backend'], r['mode'], r['n'], r['seconds'],
+          r['throughput'] or 0, ms(r['p50']), ms(r['p95']), ms(r['p99']),
+          r['bytes'] / 1024, r['errors'], r['peakrss'] or ''))
+
+
+def main(argv = None):
+  p = argparse.ArgumentParser(description = 'Benchmark the sympyprt '
+    'backends with the expressions of test_sympyprt.py.')
+  p.add_argument('--backends', default = ','.join(_backends),
+    help = 'comma separated methods (default: %(default)s)')
+  p.add_argument('--modes', default = ','.join(_modes),
+    help = 'comma separated cache modes (default: %(default)s)')
+  p.add_argument('--repeat', type = int, default = 1,
+    help = 'render the corpus n times per scenario')
+  p.add_argument('--workers', type = int, default = sp.gcfg.workers,
+    help = 'render threads of the parallel mode (default: %(default)s)')
+  p.add_argument('--json', metavar = 'FILE',
+    help = 'write the results as JSON (- for stdout)')
+  p.add_argument('--latex', help = 'latex command')
+  p.add_argument('--dvipng', help = 'dvipng command')
+  p.add_argument('--dvisvgm', help = 'dvisvgm command')
+  p.add_argument('--fake', type = float, nargs = '?', const = 0.0,
+    metavar = 'SECONDS', help = 'use the fake latex/dvipng/dvisvgm of '
+    'fake_tex.py, sleeping SECONDS per page (default: 0)')
+  p.add_argument('--importbudget', type = float, metavar = 'SECONDS',
+    help = 'fail if importing sympyprt takes longer (or loads a backend)')
+  p.add_argument('--scenario', help = argparse.SUPPRESS) # backend:mode
+  argv = sys.argv[1:] if argv is None else list(argv)
+  args = p.parse_args(argv)
+
+  if args.fake is not None:
+    import fake_tex
+    fake_tex.install(sp.gcfg, pagedelay = args.fake)
+
+  for tool in ('latex', 'dvipng', 'dvisvgm'):
+    if getattr(args, tool):
+      setattr(sp.gcfg, tool, getattr(args, tool))
+
+  # One scenario (in the process started by isolated): its result as JSON
+  if args.scenario:
+    backend, mode = args.scenario.split(':')
+    # Private format and disk cache directories (nothing shared with the
+    # user)
+    tmp = tempfile.mkdtemp(prefix = 'bench-sympyprt-')
+    sp.gcfg.fmtdir = os.path.join(tmp, 'fmt')
+    sp.gcfg.diskcachedir = os.path.join(tmp, 'disk')
+    sp.gcfg.asyncrender = False
+    try:
+      run = scenario(corpus() * args.repeat, backend, mode, args.workers)
+    finally:
+      sp.stopWorkers()
+      shutil.rmtree(tmp, True)
+    print(json.dumps(run))
+    return
+
+  imp = importTime(sp.__name__)
+  runs = []
+  for backend in args.backends.split(','):
+    for mode in args.modes.split(','):
+      if mode in _latexmodes and backend not in ('latex', 'svg'):
+        continue
+      run = isolated(backend, mode, argv)
+      if run is None:
+        print('%s %s: failed' % (backend, mode), file = sys.stderr)
+      else:
+        runs.append(run)
+
+  if args.json == '-':
+    json.dump(result(runs, args, imp), sys.stdout, indent = 1,
+              sort_keys = True)
+    print()
+  else:
+    report(runs)
+    print('import %s: %s ms, backends loaded: %s' % (sp.__name__,
+      '?' if imp[0] is None else '%.1f' % (1000 * imp[0]),
+      ' '.join(imp[1]) or 'none'))
+    if args.json:
+      f = open(args.json, 'w')
+      json.dump(result(runs, args, imp), f, indent = 1, sort_keys = True)
+      f.close()
+
+  if args.importbudget is not None and (imp[0] is None or imp[1] or
+                                        imp[0] > args.importbudget):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+# ==============================
+# Fake latex, dvipng and dvisvgm
+# ==============================
+#
+# Stand-ins for the TeX programs used by sympyprt and texprt, to measure
+# (and test) the Python side of the render path on a box without a TeX
+# distribution:
+#
+#   import sympyprt, fake_tex
+#   fake_tex.install(sympyprt.gcfg, delay = 0.0, pagedelay = 0.005)
+#
+# sets fs.latex, fs.dvipng and fs.dvisvgm of the config to this script.
+# It is run as
+#
+#   python fake_tex.py latex|dvipng|dvisvgm [--delay s] [--pagedelay s] ...
+#
+# with the usual command line options of the real program and
+#
+#   latex ..... reads the document from stdin and writes texput.dvi: one
+#               page per \setcounter{page}{n} ... \clearpage (or the whole
+#               body), \count0 = n, the source text as a special. With
+#               -interaction=scrollmode it works like the persistent worker
+#               of sympyprt (pages and \write16 markers as they arrive),
+#               -ini dumps a "format" and -fmt= checks that it exists.
+#               A source containing \fakeerror is a TeX error, one with
+#               \fakesleep{s} hangs for s seconds (a runaway formula).
+#   dvipng .... writes one png per page (-o name or name%d, --follow and
+#               --dvinum as dvipng), sized by the source text and the
+#               resolution, in the -fg/-bg colors.
+#   dvisvgm ... writes an svg of the first page to stdout (--stdout).
+#
+# --delay is slept once per run, --pagedelay per page typeset/converted.
+# The output is valid dvi/png/svg but of course no typesetting.
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+from __future__ import division, print_function
+
+import os, sys
+import io
+import re
+import time
+import struct
+import zlib
+
+_PRE = b'\xf7\x02' + struct.pack('>iii', 25400000, 473628672, 1000) + \
+       b'\x09fake_tex.'
+
+_SETPAGE = re.compile(r'\\setcounter\{page\}\{(-?\d+)\}')
+_PADDING = re.compile(r'\\count0=-(\d+)\\shipout')
+_MARKER = re.compile(r'\\write16\{(.*?)\}')
+_ERROR = '\\fakeerror'
+_SLEEP = re.compile(r'\\fakesleep\{([0-9.]+)\}')
+
+# dvipng --follow gives up if the dvi file doesn't appear in time
+_FOLLOWWAIT = 10.0
+
+_colors = {'black': (0, 0, 0), 'white': (1, 1, 1), 'red': (1, 0, 0),
+           'green': (0, 1, 0), 'blue': (0, 0, 1), 'cyan': (0, 1, 1),
+           'magenta': (1, 0, 1), 'yellow': (1, 1, 0)}
+
+
+def install(cfg, delay = 0.0, pagedelay = 0.0):
+  """
+  Use the fakes for the latex, dvipng and dvisvgm commands of cfg (an fs
+  of sympyprt or texprt). Returns cfg.
+  """
+  path = os.path.abspath(__file__)
+  if path.endswith(('.pyc', '.pyo')):
+    path = path[:-1]
+  cmd = '"%s" -S -E "%s" %%s --delay %g --pagedelay %g' % (sys.executable,
+    path, delay, pagedelay)
+  cfg.latex = cmd % 'latex'
+  cfg.dvipng = cmd % 'dvipng'
+  cfg.dvisvgm = cmd % 'dvisvgm'
+  return cfg
+
+
+#;;;;;;;;;;;;;
+# DVI ;;;
+#;;;;;;;;;;;;;
+def dviPage(c0, text, prev = -1):
+  """
+  A dvi page (bop ... eop) with \\count0 = c0 and text as xxx special.
+  """
+  s = text.encode('utf-8')
+  return b'\x8b' + struct.pack('>10i', c0, 0, 0, 0, 0, 0, 0, 0, 0, 0) + \
+    struct.pack('>i', prev) + b'\xf2' + struct.pack('>I', len(s)) + s + b'\x8c'
+
+def dviPost(out, pages, prev):
+  """
+  Append the postamble for pages pages (prev: offset of the last bop) to
+  the dvi bytearray out.
+  """
+  post = len(out)
+  out += b'\xf8' + struct.pack('>i', prev) + _PRE[2:14] + \
+    struct.pack('>iiHH', 0, 0, 1, pages)
+  out += b'\xf9' + struct.pack('>i', post) + b'\x02'
+  out += b'\xdf' * (4 + (-len(out) - 4) % 4)
+  return out
+
+def dviPages(b, i = 0):
+  """
+  Parse the complete pages of the dvi bytes b from offset i (0: after the
+  preamble). Returns ([(count0, text), ...], offset after the last complete
+  page, True if the postamble was reached).
+  """
+  b = bytearray(b)
+  pages = []
+  if i == 0:
+    if len(b) < 15 or len(b) < 15 + b[14]:
+      return pages, 0, False
+    i = 15 + b[14]
+  while i < len(b):
+    op = b[i]
+    if op == 138: # nop
+      i += 1
+      continue
+    if op != 139: # post (or anything not written by fake_tex)
+      return pages, i, True
+    if i + 45 > len(b):
+      break
+    c0 = struct.unpack('>i', bytes(b[i + 1:i + 5]))[0]
+    j = i + 45
+    text = []
+    while j < len(b) and b[j] != 140:
+      op = b[j]
+      if 239 <= op <= 242: # xxx
+        n = op - 238
+        if j + 1 + n > len(b): break
+        k = 0
+        for v in b[j + 1:j + 1 + n]:
+          k = (k << 8) | v
+        text.append(bytes(b[j + 1 + n:j + 1 + n + k]))
+        j += 1 + n + k
+      elif op in (138, 141, 142):
+        j += 1
+      else:
+        return pages, i, True
+    if j >= len(b):
+      break
+    pages.append((c0, b''.join(text).decode('utf-8', 'replace')))
+    i = j + 1
+  return pages, i, False
+
+
+#;;;;;;;;;;;;;
+# latex ;;;
+#;;;;;;;;;;;;;
+class Typesetter():
+  """
+  Splits the input lines into pages and ships them out to the dvi file.
+  """
+
+  def __init__(self, path, pagedelay, stream = False):
+    self.path = path
+    self.pagedelay = pagedelay
+    self.stream = stream # write each page at once (worker)
+    self.out = bytearray(_PRE)
+    self.written = 0
+    self.bop = -1
+    self.pages = 0
+    self.page = None # \count0 of the open page
+    self.text = []
+    self.error = False
+
+  def line(self, s):
+    """
+    Process one input line, returns the output for the terminal.
+    """
+    out = []
+    if _ERROR in s:
+      self.error = True
+      out.append('! Undefined control sequence.\nl.1 \\fakeerror\n')
+    m = _SLEEP.search(s)
+    if m:
+      time.sleep(float(m.group(1)))
+    m = _SETPAGE.search(s)
+    if m:
+      self.page, self.text = int(m.group(1)), []
+      s = s[m.end():]
+    if '\\begin{document}' in s:
+      self.page, self.text = 1, []
+      s = s.split('\\begin{document}', 1)[1]
+    m = _MARKER.search(s)
+    if m:
+      out.append(m.group(1) + '\n')
+    elif '\\clearpage' in s or '\\end{document}' in s:
+      self.text.append(re.split(r'\\clearpage|\\end\{document\}', s)[0])
+      self.ship()
+    elif self.page is not None:
+      self.text.append(s)
+    m = _PADDING.search(s)
+    if m:
+      self.shipout(-int(m.group(1)), s[m.end():])
+    return ''.join(out)
+
+  def ship(self):
+    """
+    Ship out the open page (if not empty).
+    """
+    text = re.sub(r'\\(begin|end)group', '', ''.join(self.text)).strip()
+    if self.page is not None and text:
+      time.sleep(self.pagedelay)
+      self.shipout(self.page, text)
+    self.page, self.text = None, []
+
+  def shipout(self, c0, text):
+    last = len(self.out)
+    self.out += dviPage(c0, text, self.bop)
+    self.bop = last
+    self.pages += 1
+    if self.stream:
+      self.flush()
+
+  def flush(self):
+    f = open(self.path, 'ab' if self.written else 'wb')
+    f.write(self.out[self.written:])
+    f.close()
+    self.written = len(self.out)
+
+  def finish(self):
+    self.ship()
+    if self.pages:
+      dviPost(self.out, self.pages, self.bop)
+      self.flush()
+
+
+def latex(args, delay, pagedelay):
+  jobname, fmt, ini, worker = 'texput', None, False, False
+  for a in args:
+    if a.startswith('-jobname='):
+      jobname = a.split('=', 1)[1]
+    elif a.startswith('-fmt='):
+      fmt = a.split('=', 1)[1].strip('"')
+    elif a == '-ini':
+      ini = True
+    elif a == '-interaction=scrollmode':
+      worker = True
+  time.sleep(delay)
+
+  # Dump: the "format" is the preamble
+  if ini:
+    src = open(jobname + '.tex', 'rb').read()
+    f = open(jobname + '.fmt', 'wb')
+    f.write(b'fake_tex format\n' + src)
+    f.close()
+    return 0
+
+  if fmt and not os.path.exists(fmt if fmt.endswith('.fmt') else
+                                fmt + '.fmt'):
+    print("I can't find the format file `%s'!" % fmt)
+    return 1
+
+  stdin = io.open(sys.stdin.fileno(), 'rb', closefd = False)
+  tex = Typesetter(jobname + '.dvi', pagedelay, worker)
+  if worker:
+    for line in iter(stdin.readline, b''):
+      out = tex.line(line.decode('utf-8', 'replace'))
+      if out:
+        sys.stdout.write(out)
+        sys.stdout.flush()
+    return 0
+
+  for line in stdin.read().decode('utf-8', 'replace').splitlines(True):
+    sys.stdout.write(tex.line(line))
+  if tex.error:
+    return 1
+  tex.finish()
+  if not tex.pages:
+    print('No pages of output.')
+  return 0
+
+
+#;;;;;;;;;;;;;;
+# dvipng ;;;
+#;;;;;;;;;;;;;;
+def color(v):
+  """
+  The rgb triple (0..255) of the dvipng color v (list of words), None
+  for Transparent.
+  """
+  try:
+    if v[0] == 'rgb':
+      return tuple(int(255 * float(x)) for x in v[1:4])
+    if v[0] == 'gray':
+      return (int(255 * float(v[1])),) * 3
+    if v[0] == 'cmyk':
+      c = [float(x) for x in v[1:5]]
+      return tuple(int(255 * (1 - min(1, x + c[3]))) for x in c[:3])
+  except (ValueError, IndexError):
+    return (0, 0, 0)
+  if v[0].lower() == 'transparent':
+    return None
+  return tuple(255 * x for x in _colors.get(v[0].lower(), (0, 0, 0)))
+
+def _chunk(t, d):
+  return struct.pack('>I', len(d)) + t + d + \
+         struct.pack('>I', zlib.crc32(t + d) & 0xffffffff)
+
+def png(text, dpi, fg, bg):
+  """
+  An rgba png for text: a striped "glyph" band in fg on bg (None:
+  transparent), about as wide as the typeset text would be.
+  """
+  w = max(8, min(4000, len(text) * dpi // 20))
+  h = max(8, dpi // 6)
+  back = bytearray((bg or (255, 255, 255)) + (255 if bg else 0,))
+  fore = bytearray(fg + (255,))
+  rows = []
+  for pattern in (0, 1):
+    r = bytearray(b'\x00')
+    for x in range(w):
+      r += fore if (x // 3) % 2 == pattern else back
+    rows.append(bytes(r))
+  blank = bytes(b'\x00' + back * w)
+  raw = b''.join(rows[(y // 4) % 2] if h // 4 <= y < h - h // 4 else blank
+                 for y in range(h))
+  return b'\x89PNG\r\n\x1a\n' + \
+    _chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)) + \
+    _chunk(b'IDAT', zlib.compress(raw, 6)) + _chunk(b'IEND', b'')
+
+def options(args):
+  """
+  Parse the dvipng/dvisvgm command line: (options, dvi file). A color
+  option takes all the words of the color (-fg rgb 1 0 0).
+  """
+  opts, dvi, i = {}, None, 0
+  while i < len(args):
+    a = args[i]
+    if a in ('-fg', '-bg'):
+      v = args[i + 1:i + 2]
+      n = {'rgb': 3, 'gray': 1, 'cmyk': 4}.get(v[0] if v else '', 0)
+      opts[a] = args[i + 1:i + 2 + n]
+      i += 2 + n
+    elif a in ('-T', '-D', '-O', '-o'):
+      opts[a] = args[i + 1]
+      i += 2
+    elif a.startswith('-'):
+      opts[a] = True
+      i += 1
+    else:
+      dvi = a
+      i += 1
+  return opts, dvi
+
+def dvipng(args, delay, pagedelay):
+  opts, dvi = options(args)
+  time.sleep(delay)
+  dpi = int(opts.get('-D', 100))
+  fg = color(opts.get('-fg', ['Black'])) or (0, 0, 0)
+  bg = color(opts.get('-bg', ['White']))
+  name = opts.get('-o', os.path.splitext(dvi)[0] + '%d.png')
+
+  def write(pages, k):
+    for c0, text in pages:
+      k += 1
+      time.sleep(pagedelay)
+      n = c0 if '--dvinum' in opts else k
+      out = name % n if '%' in name else name
+      f = open(out + '.tmp', 'wb')
+      f.write(png(text, dpi, fg, bg))
+      f.close()
+      os.rename(out + '.tmp', out)
+    return k
+
+  if '--follow' not in opts:
+    try:
+      b = open(dvi, 'rb').read()
+    except IOError:
+      print('dvipng: no dvi file %s' % dvi)
+      return 1
+    pages = dviPages(b)[0]
+    write([p for p in pages if p[0] > 0] or pages[:1], 0)
+    return 0
+
+  # --follow: convert the pages as they are appended to the dvi. Like the
+  # real dvipng it keeps waiting when the dvi is removed (the worker has to
+  # kill it), but gives up if no dvi appears within _FOLLOWWAIT.
+  pos, k, buf = 0, 0, b''
+  deadline = time.time() + _FOLLOWWAIT
+  while True:
+    try:
+      f = open(dvi, 'rb')
+      f.seek(len(buf))
+      buf += f.read()
+      f.close()
+    except IOError:
+      if not buf and time.time() > deadline:
+        print('dvipng: no dvi file %s' % dvi)
+        return 1
+    pages, pos, done = dviPages(buf, pos)
+    k = write([p for p in pages if p[0] > 0], k)
+    if done:
+      return 0
+    time.sleep(0.002)
+
+
+#;;;;;;;;;;;;;;;
+# dvisvgm ;;;
+#;;;;;;;;;;;;;;;
+def dvisvgm(args, delay, pagedelay):
+  opts, dvi = options(args)
+  time.sleep(delay)
+  try:
+    pages = dviPages(open(dvi, 'rb').read())[0]
+  except IOError:
+    pages = []
+  if not pages:
+    sys.stderr.write('dvisvgm: no pages in %s\n' % dvi)
+    return 1
+  time.sleep(pagedelay)
+  text = pages[0][1]
+  w, h = max(1, len(text)) * 5, 12
+  sys.stdout.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+    'width="%dpt" height="%dpt" viewBox="0 0 %d %d">\n'
+    '<g id="page1"><rect x="0" y="3" width="%d" height="6"/></g>\n'
+    '</svg>\n' % (w, h, w, h, w))
+  return 0
+
+
+def main(argv = None):
+  args = list(sys.argv[1:] if argv is None else argv)
+  if not args or args[0] not in ('latex', 'dvipng', 'dvisvgm'):
+    print('usage: fake_tex.py latex|dvipng|dvisvgm [--delay s] '
+          '[--pagedelay s] options')
+    return 2
+  prog, delay, pagedelay = args.pop(0), 0.0, 0.0
+  while args and args[0] in ('--delay', '--pagedelay'):
+    if args[0] == '--delay':
+      delay = float(args[1])
+    else:
+      pagedelay = float(args[1])
+    del args[:2]
+  return globals()[prog](args, delay, pagedelay)
+
+if __name__ == '__main__':
+  sys.exit(main())
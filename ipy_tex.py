@@ -73,11 +73,12 @@
 Doc:
 """
 
-import os, os.path, re, subprocess
+import os, os.path, re, subprocess, threading
 
 from IPython.lib.latextools import latex_to_png
 from matplotlib.mathtext import MathTextParser, MathtextBackendBitmap
 from tempfile import NamedTemporaryFile
+from collections import OrderedDict
 
 from StringIO import StringIO
 from base64 import encodestring
@@ -126,14 +127,10 @@ class TeX1():
       self.render()
 
   def render(self):
-    self.mtp = MathTextParser('bitmap')
-    f = StringIO()
-    self.mtp.to_png(f, self.texstr, self.color, self.dpi, self.fontsize)
-    bin_data = f.getvalue()
+    bin_data = mathPNG(self.texstr, self.color, self.dpi, self.fontsize)
     if self.encode:
       bin_data = encodestring(bin_data)
     self.png = bin_data
-    f.close()
 
   def set_texstr(self, texstr):
     self.texstr = texstr
@@ -159,6 +156,41 @@ class TeX1():
     return self.png
 
 
+# Idle mathtext parsers shared by all TeX1 instances (parse cache and
+# fonts stay warm) and a memo (texstr, color, dpi, fontsize) -> PNG
+_parsers = []
+_memo = OrderedDict()
+_memo_size = 500
+_lock = threading.Lock()
+
+def mathPNG(texstr, color, dpi, fontsize):
+  """
+  The mathtext PNG of texstr (memoized, the last _memo_size are kept).
+  """
+  key = (texstr, color, dpi, fontsize)
+  with _lock:
+    if key in _memo:
+      png = _memo[key] = _memo.pop(key)
+      return png
+    mtp = _parsers.pop() if _parsers else None
+  try:
+    if mtp is None:
+      mtp = MathTextParser('bitmap')
+    f = StringIO()
+    mtp.to_png(f, texstr, color, dpi, fontsize)
+    png = f.getvalue()
+    f.close()
+  finally:
+    with _lock:
+      if mtp is not None:
+        _parsers.append(mtp)
+  with _lock:
+    _memo[key] = png
+    while len(_memo) > _memo_size:
+      _memo.popitem(last = False)
+  return png
+
+
 #;;;;;;;;;;;;;;;
 # Class TeX2 ;;;
 #;;;;;;;;;;;;;;;
@@ -180,6 +212,7 @@ class TeX2():
     pt = #        Font size set in \documentstyle[#pt]
 
     cleanup = True | False ... removes .aux, .tex, .log and .dvi files.
+    diskcache = True | False ... use the on-disk image cache of sympyprt.
     latex_template = Tex preambel + begin/end{document}
 
      # = number   f = file   s = string  * = suffix, '0' to turn off
@@ -194,7 +227,8 @@ class TeX2():
   """
 
   def __init__(self, tex, pt = 12, D = 150, T = 'tight', bg = 'White',
-    fg = 'Blue', O = '0cm, 0cm', bd = '0', cleanup = True, init_render = True):
+    fg = 'Blue', O = '0cm, 0cm', bd = '0', cleanup = True, init_render = True,
+    diskcache = False):
 
     self.tex = tex
     self.pt = pt
@@ -206,6 +240,7 @@ class TeX2():
     self.bd = bd
     self.cleanup = cleanup
     self.init_render = init_render
+    self.diskcache = diskcache
 
 
     self.latex_exe = 'latex'
@@ -232,6 +267,20 @@ class TeX2():
 
   def render(self):
 
+    # On-disk cache (shared with sympyprt)
+    disk = None
+    if self.diskcache:
+      try:
+        from sympyprt import getDiskCache, contentKey
+        disk = getDiskCache()
+        key = contentKey('ipy_tex', self.tex, self.pt, self.D, self.T,
+          self.bg, self.fg, self.O, self.bd, self.latex_template)
+        self.png = disk.get(key)
+        if self.png is not None:
+          return
+      except ImportError:
+        disk = None
+
     # Create a named temporary file for the TeX source code
     tex_file = NamedTemporaryFile(suffix = ".tex", delete = False)
     tex_file_name = tex_file.name
@@ -288,6 +337,9 @@ class TeX2():
     self.png = f.read()
     f.close()
 
+    if disk is not None:
+      disk.put(key, self.png)
+
   def remove_pngfile(self):
     os.remove(self.pngfile)
 
@@ -298,19 +350,30 @@ class TeX2():
 #;;;;;;;;;;;;;;;;;;;;;;;;;
 # DISPLAY TeX Function ;;;
 #;;;;;;;;;;;;;;;;;;;;;;;;;
+# Not in mathtext (environments, line breaks, text) => TeX2 directly
+_needlatex = re.compile(r'\\begin|\\\\|\\text|\\substack|\\boxed|\\cancel')
+
+# Sources mathtext failed on (not tried again)
+_mathfail = OrderedDict()
+
 def dt(arg, m = 1):
  """
  Create a TeX instance. Try the matplotlib version first (quite fast) otherwise
- try the dvipng version (may be a little slower).
+ try the dvipng version (may be a little slower). Sources mathtext can't
+ render (see _needlatex, failed before) go to the dvipng version at once.
  Note: the instance is available with _n, where n is the ipy output number.
  The available attributes depend on the class used.
  """
 
- if m == 2: return TeX2(arg)
+ if m == 2 or _needlatex.search(arg) or arg in _mathfail: return TeX2(arg)
 
  try:
    return TeX1(arg)
  except:
+   with _lock:
+     _mathfail[arg] = True
+     while len(_mathfail) > _memo_size:
+       _mathfail.popitem(last = False)
    return TeX2(arg)
 
 
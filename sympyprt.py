@@ -59,14 +59,23 @@ Description:
     sympyprt matrix v           ;; set matrix border; p,v,b,V,B,small
     sympyprt breqn on           ;; use the breqn package; on/off
     sympyprt mode equation      ;; choose mode; inline, equation, equation*
+    sympyprt worker off         ;; run a new latex process for each formula
+                                   instead of the persistent worker.
+    sympyprt cache maxbytes 64M ;; limit the image cache (also: maxentries,
+                                   policy lru|lfu, stats, clear)
+    sympyprt cache disk on      ;; also keep the images in fs.diskcachedir
+                                   (shared by kernels, survives restarts)
 
 Advanced usage:
   To access the internals do as follows (for example):
     from sympyprt import *
     fs .................. factory settings (class)
     gcfg ................ global config (instance of fs)
-    ObjCache ............ display the object cache (this is a dict)
-                          ObjCache[id(<sympy_object>)] -> TeX instance
+    ObjCache ............ display the object cache (a dict like RenderCache)
+                          ObjCache[objKey(<sympy_object>)] -> CacheEntry
+                          (png/svg, src and a shared cfg snapshot)
+                          The key is a hash of the LaTeX code and all
+                          settings which affect the image (renderKey).
                           There are also exposed manipulation functions
                           like putObj, getObj, hasObj, getPNG ...
     gcfg = fs() ......... reset the global cfg to factory settings
@@ -79,23 +88,32 @@ Advanced usage:
 
 Examples:
   - for x in ObjCache.values():
-      print x.tex # the TeX code of the object
+      print x.src # the TeX code of the object
 
   - from sympyprt import TeX2 as tex
       tex(r'This text was rendered with \LaTeX')
 
+  - print_png_batch(Obj) .. render a list of objects with one latex run
+                            and one dvipng call (fills the cache), then
+                            for obj in Obj: display(obj)
+    TeX2.render_many(srcs)  the same for a list of TeX sources.
+  - %sympyprt workers 4 ...... render cache misses in 4 threads (a batch is
+                               split into 4 chunks).
+  - %sympyprt async on ....... display a placeholder (pretty text) and
+                               update it in place when rendered.
+
 Magic name:
   If one prefers another name for the %sympyprt magic change the global
   variable fs._magic in the code below.
 
 Note:
-  Many (if not most) objects are cached with its 'id'. When typing
-  _n ([n] = IPy output number) a cached image will be shown. There
-  are several methods to redraw the image;
-        1. delete it from the cache
-        2. get the instance from the cache and use its render() method
-           e.g. x.render(x.cfg) => new x.png (if x.cfg was modified).
-        3. delete the original object, so that simpy creates a new one (id)
+  Objects are cached by their content (LaTeX code + settings), i.e. equal
+  expressions share one image and changing a setting (e.g. fontsize)
+  renders a new one. To redraw an image;
+        1. delete it from the cache: del ObjCache[objKey(x)]
+        2. get the entry from the cache and use its render() method
+           e.g. x.render(snapshot(x.cfg, fontsize = 12)) => new x.png
+           (x.cfg is a frozen snapshot, shared by many entries).
 
 Credit(s):
   based on ipython/extensions/sympyprinting.py by Brian Granger
@@ -110,15 +128,83 @@ __loc_id__ = "hg.scios.ch/py_site_scios_tex"
 #;;;;;;;;;;;;
 import os, os.path
 import re
+import time
+import atexit
+import hashlib
+import json
+import shutil
+import signal
+import struct
+import tempfile
+import threading
+import weakref
+import zlib
+
+from subprocess import Popen, PIPE, STDOUT
+from itertools import count
+from multiprocessing import cpu_count
+from collections import OrderedDict, deque
+from Queue import Queue, Empty
 
-from subprocess import Popen, PIPE
-from copy import copy
-
-from IPython.lib.latextools import latex_to_png
-from matplotlib.mathtext import MathTextParser, MathtextBackendBitmap
-from sympy import latex ,pretty
-from StringIO import StringIO
 from base64 import encodestring
+from io import BytesIO
+
+
+#;;;;;;;;;;;;;;;;;
+# Lazy imports ;;;
+#;;;;;;;;;;;;;;;;;
+class _Lazy():
+  """
+  A module (or an attribute of it) imported on first use. The backends
+  (IPython latextools, matplotlib, numpy, sympy's printers) are only
+  loaded when a method needs them, which keeps %load_ext fast.
+  """
+
+  def __init__(self, module, attr = None):
+    self._module = module
+    self._attr = attr
+    self._obj = None
+
+  def _load(self):
+    if self._obj is None:
+      m = __import__(self._module, fromlist = ['*'])
+      self._obj = getattr(m, self._attr) if self._attr else m
+    return self._obj
+
+  def __getattr__(self, name):
+    return getattr(self._load(), name)
+
+  def __call__(self, *args, **kw):
+    return self._load()(*args, **kw)
+
+latex_to_png = _Lazy('IPython.lib.latextools', 'latex_to_png')
+MathTextParser = _Lazy('matplotlib.mathtext', 'MathTextParser')
+latex = _Lazy('sympy', 'latex')
+pretty = _Lazy('sympy', 'pretty')
+
+np = _Lazy('numpy')
+to_rgb = _Lazy('matplotlib.colors', 'to_rgb')
+imread = _Lazy('matplotlib.image', 'imread')
+
+
+#;;;;;;;;;;;;
+# Helpers ;;;
+#;;;;;;;;;;;;
+def _bytes(s):
+  """
+  Encode s (utf-8) for writing to a pipe.
+  """
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  return s
+
+def _text(b):
+  """
+  Decode b (process output) to text.
+  """
+  if not isinstance(b, str):
+    return b.decode('utf-8', 'replace')
+  return b
 
 
 #;;;;;;;;;;;;;;;;;;;;;
@@ -128,10 +214,12 @@ class fs: pass
 fs._active = True
 fs._magic = 'sympyprt'
 fs._loaded = False
-fs._methods = ['simple', 'mplib', 'latex']
+fs._methods = ['simple', 'mplib', 'latex', 'svg', 'auto']
 fs._use = 'latex'
 fs._params = ['fontsize', 'resolution', 'imagesize', 'textcolor',
-              'backcolor', 'offset', 'reset']
+              'backcolor', 'offset', 'reset', 'worker', 'workers', 'fmt',
+              'async', 'recolor', 'fallback', 'purge', 'budget',
+              'overbudget', 'timeout']
 
 fs.latex = 'latex'
 fs.dvipng = 'dvipng'
@@ -161,11 +249,129 @@ fs.dvipngcmd = r"{0} -T {1} -D {2:d} -bg {3} -fg {4} -O {5} -o {6} {7}"
 fs.jobname = 'texput'
 fs.dvifile = fs.jobname + '.dvi'
 fs.pngfile = fs.jobname + '.png'
+fs.pngpages = fs.jobname + '%d.png' # batch output (dvipng -o)
+
+# SVG output (method svg, TeX3): glyphs as paths, each one defined once
+fs.dvisvgm = 'dvisvgm'
+fs.dvisvgmcmd = r"{0} --no-fonts --exact --stdout {1}"
 
 fs.exts = ['dvi','aux','png','log'] # removed
 
+# Each render runs in its own scratch directory below scratchdir (tmpfs
+# if available, None => system temp dir), removed by cleanup
+fs.scratchdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 fs.errdvipng = 'Error (dvipng): use the log property for more information.'
+fs.errdvisvgm = 'Error (dvisvgm): use the log property for more information.'
 fs.errlatex = 'Error (latex): use the log property for more information.'
+fs.errworker = 'Error (worker): latex worker died, restarting it.'
+
+# Persistent latex worker (TeX2): the preamble is loaded once and every
+# formula is typeset as a new page of the same (growing) dvi file.
+fs.worker = True
+fs.workercmd = r"{0} -interaction=scrollmode"
+fs.workertimeout = 30     # seconds to wait for a page (<= rendertimeout)
+fs.workermaxpages = 200   # restart the worker after that many pages
+fs.dvibufsize = 16384     # TeX's dvi_buf_size (see texmf.cnf)
+
+# dvipng --follow: every worker has a dvipng process converting its pages
+# while latex ships them out (pages are numbered by \count0)
+fs.follow = True
+fs.followopt = r" --follow --dvinum"
+
+# Render threads (TeX2): cache misses are rendered in parallel by up to
+# fs.workers threads, each with its own latex worker (0 => no threads)
+try:
+  fs.workers = cpu_count()
+except NotImplementedError:
+  fs.workers = 2
+
+# Asynchronous display (IPython 5.4+): show a placeholder (placeholder =
+# pretty: unicode text, mplib: matplotlib image) and replace it in place
+# when the render thread is done (needs fs.workers > 0)
+fs.asyncrender = False
+fs.placeholder = 'pretty'
+
+# Precompiled format files: the preamble (up to \begin{document}) of each
+# distinct preamble/fontsize is dumped once into fs.fmtdir and latex is
+# started with -fmt. The file name is a hash of the preamble text.
+# fs.fmtdir must be private (owned by the user, mode 0700), formats are
+# not used otherwise.
+fs.fmt = True
+fs.fmtbase = 'latex'
+fs.fmtdir = os.path.join(os.environ.get('XDG_CACHE_HOME',
+  os.path.join(os.path.expanduser('~'), '.cache')), 'sympyprt', 'fmt')
+fs.fmtcmd = r'{0} -ini -interaction=nonstopmode -jobname={1} "&{2}" {1}.tex'
+fs.fmtopt = r' -fmt="{0}"'
+
+# Image cache limits (total PNG bytes, number of entries) and eviction
+# policy: lru (least recently used) or lfu (least frequently used)
+fs.cachemaxbytes = 32 * 1024 * 1024
+fs.cachemaxentries = 5000
+fs.cachepolicy = 'lru'
+
+# Dvi cache: the latex output of each formula (key: source, preamble and
+# fontsize), so colors, resolution, imagesize or offset only rerun dvipng
+fs.dvicache = True
+fs.dvicachemaxbytes = 16 * 1024 * 1024
+fs.dvicachemaxentries = 5000
+
+# Render statistics: samples kept per backend and stage (%sympyprt stats)
+fs.statssamples = 5000
+
+# Method auto: formulas mathtext can't do (environments, line breaks,
+# text, longer than automaxlen => breqn) are rendered by latex, the others
+# by the method with the lowest measured cost (mean time / success rate;
+# autoprior until autominruns renders were measured)
+fs.automaxlen = 300
+fs.autoprior = {'mplib': 0.01, 'latex': 0.2}
+fs.autominruns = 5
+
+# Negative cache: formulas latex/dvipng failed on (key as ObjCache, i.e.
+# a new preamble or other settings try again) with the log. They are shown
+# by the fallback method at once: mplib (mathtext) or text
+fs.fallback = 'mplib'
+fs.failcachemaxbytes = 4 * 1024 * 1024
+fs.failcachemaxentries = 500
+
+# Render budget: formulas whose estimated cost (see renderCost: length and
+# squared line length of the LaTeX code, matrix cells, breqn) exceeds
+# fs.budget (0: no limit) are not rendered by the latex method but shown as
+# text, truncated (leading terms of a sum) or rendered in the background
+# (defer). Single latex, dvipng and dvisvgm runs are killed after
+# fs.rendertimeout seconds.
+fs.budget = 10000
+fs.overbudget = 'text' # text|truncate|defer
+fs.rendertimeout = 30
+
+# Memo of the LaTeX code of sympy objects (key: the expression and the
+# printer settings mode, matrix and breqn)
+fs.latexcachemaxbytes = 8 * 1024 * 1024
+fs.latexcachemaxentries = 2000
+
+# The displayed objects are tracked by weak references (or by id, then
+# they are searched in Out, _, __ and ___): after a cell (IPython
+# post_execute) the LaTeX code and the images of the collected ones (e.g.
+# after %reset out) are removed from the caches. Off: no search, images kept
+fs.purge = True
+
+# Memo of the mplib method: PNG of (source, color, resolution, fontsize)
+fs.mathcachemaxbytes = 4 * 1024 * 1024
+fs.mathcachemaxentries = 2000
+
+# Coverage masks: the alpha of each rendered formula (key: everything but
+# the colors), so a textcolor/backcolor change only colorizes the mask
+# (numpy) and encodes a new png instead of running dvipng or mathtext
+fs.recolor = True
+fs.maskcachemaxbytes = 16 * 1024 * 1024
+fs.maskcachemaxentries = 5000
+
+# Optional on-disk PNG cache shared by kernels (and texprt, ipy_tex),
+# garbage collected (least recently used first) above diskcachemaxbytes
+fs.diskcache = False
+fs.diskcachedir = os.path.join(os.environ.get('XDG_CACHE_HOME',
+  os.path.join(os.path.expanduser('~'), '.cache')), 'sympyprt')
+fs.diskcachemaxbytes = 256 * 1024 * 1024
 
 fs.configscript = None
 
@@ -182,6 +388,25 @@ def paramap(c):
   'matrix'     : c.matrix,
   'breqn'      : c.breqn,
   'method'     : c._use,
+  'worker'     : c.worker,
+  'follow'     : c.follow,
+  'workers'    : c.workers,
+  'async'      : c.asyncrender,
+  'placeholder' : c.placeholder,
+  'fmt'        : c.fmt,
+  'cachemaxbytes'   : c.cachemaxbytes,
+  'cachemaxentries' : c.cachemaxentries,
+  'cachepolicy'     : c.cachepolicy,
+  'dvicache'        : c.dvicache,
+  'recolor'         : c.recolor,
+  'purge'           : c.purge,
+  'budget'          : c.budget,
+  'overbudget'      : c.overbudget,
+  'timeout'         : c.rendertimeout,
+  'fallback'        : c.fallback,
+  'diskcache'       : c.diskcache,
+  'diskcachedir'    : c.diskcachedir,
+  'diskcachemaxbytes' : c.diskcachemaxbytes,
   'preamble'   : c.preamble}
 
 
@@ -189,10 +414,11 @@ def paramap(c):
 # The factory settings may be overwritten here. ;;;
 # Optional configscript: fs.configscript        ;;;
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
-try:
-  execfile(fs.configscript)
-except:
-  pass
+if fs.configscript:
+  try:
+    execfile(fs.configscript)
+  except:
+    pass
 
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 # Global config obj (instance of fs) ;;;
@@ -200,15 +426,570 @@ except:
 gcfg = fs()
 
 
+#;;;;;;;;;;;;;;;;;;;;;;;
+# Config snapshots ;;;
+#;;;;;;;;;;;;;;;;;;;;;;;
+# The settings which affect the pixels of an image (see renderKey)
+_PIXELS = ('fontsize', 'resolution', 'imagesize', 'forecolor', 'backcolor',
+           'offset', 'mode', 'matrix', 'breqn', 'preamble')
+_SNAPATTRS = ('_snapkey', '_snaphash', '_pixels')
+
+class frozenfs(fs):
+  """
+  An immutable config (see snapshot). Snapshots are interned, i.e. equal
+  settings give the same object, so they compare by identity and hash by
+  a precomputed value. copy() returns a mutable fs with the same settings.
+  """
+
+  def __init__(self, values, key):
+    self.__dict__.update(values)
+    self.__dict__['_snapkey'] = key
+    self.__dict__['_snaphash'] = hash(key)
+    self.__dict__['_pixels'] = tuple(values[k] for k in _PIXELS)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("config snapshot is read-only (%s), use "
+                         "snapshot(cfg, %s = ...)" % (name, name))
+
+  def __delattr__(self, name):
+    raise AttributeError("config snapshot is read-only (%s)" % name)
+
+  def __hash__(self):
+    return self._snaphash
+
+  def __eq__(self, other):
+    return self is other
+
+  def __ne__(self, other):
+    return self is not other
+
+  def __copy__(self):
+    c = fs()
+    c.__dict__.update((k, v) for k, v in self.__dict__.items()
+                      if k not in _SNAPATTRS)
+    return c
+
+# Interned snapshots: settings -> frozenfs, weak (a snapshot lives as long
+# as a render, cache entry or worker holds it), _lastsnapshot keeps the
+# latest one
+_snapshots = weakref.WeakValueDictionary()
+_lastsnapshot = None
+_snapshots_lock = threading.Lock()
+
+# The settings of fs: (number of class attributes, names, set of names)
+_fsnames = (0, (), frozenset())
+
+def fsNames():
+  """
+  The sorted setting names of fs (computed again if fs got new ones).
+  """
+  global _fsnames
+  if _fsnames[0] != len(vars(fs)):
+    names = tuple(sorted(k for k in vars(fs) if not k.startswith('__')))
+    _fsnames = (len(vars(fs)), names, frozenset(names))
+  return _fsnames[1]
+
+def snapshot(cfg = gcfg, **changes):
+  """
+  The frozen snapshot of cfg (with changes applied), e.g. snapshot(gcfg)
+  for a render or snapshot(x.cfg, fontsize = 12). Shared by all callers
+  with the same settings; a snapshot without changes is returned as is.
+  """
+  if isinstance(cfg, frozenfs) and not changes:
+    return cfg
+  names = fsNames()
+  extra = [k for k in list(vars(cfg)) + list(changes)
+           if k not in _fsnames[1] and k not in _SNAPATTRS]
+  if extra:
+    names = tuple(sorted(set(names).union(extra)))
+  values = [changes[k] if k in changes else getattr(cfg, k) for k in names]
+  key = (names, tuple(repr(v) if isinstance(v, (list, dict, set)) else v
+                      for v in values))
+  global _lastsnapshot
+  with _snapshots_lock:
+    c = _snapshots.get(key)
+    if c is None:
+      c = _snapshots[key] = frozenfs(dict(zip(names, values)), key)
+    _lastsnapshot = c
+    return c
+
+def pixels(cfg):
+  """
+  The values of the _PIXELS settings of cfg (precomputed for snapshots).
+  """
+  if isinstance(cfg, frozenfs):
+    return cfg._pixels
+  return tuple(getattr(cfg, k) for k in _PIXELS)
+
+
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 # Cache + manipulation functions ;;;
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
-ObjCache = {}
-def putObj(x, y): ObjCache[id(x)] = y
-def getObj(x): return ObjCache[id(x)]
-def hasObj(x): return ObjCache.has_key(id(x))
+class RenderCache():
+  """
+  The image cache: a dict like mapping key -> CacheEntry, bounded by the
+  total size of the PNG images (maxbytes) and the number of entries
+  (maxentries). Evicts the least recently (lru) or least frequently (lfu)
+  used entries. Lookups with get() are counted as hits/misses.
+  """
+
+  def __init__(self, maxbytes, maxentries, policy = 'lru'):
+    self.maxbytes = maxbytes
+    self.maxentries = maxentries
+    self.policy = policy
+    self.data = OrderedDict() # oldest first
+    self.uses = {}            # key -> number of uses
+    self.buckets = {}         # number of uses -> OrderedDict of keys (lfu)
+    self.lowest = 0           # <= min(buckets)
+    self.nbytes = 0
+    self.hits = self.misses = self.evictions = 0
+    self.lock = threading.RLock()
+
+  @staticmethod
+  def size(y):
+    """
+    Size of an entry (its PNG or SVG image, or the entry itself if it is a
+    string like the dvi files of DviCache or an array like the masks).
+    """
+    if isinstance(y, (bytes, type(u''))):
+      return len(y)
+    if hasattr(y, 'nbytes'): # numpy array (no numpy import)
+      return y.nbytes
+    return len(getattr(y, 'png', None) or getattr(y, 'svg', None) or
+               getattr(y, 'src', None) or b'')
+
+  def get(self, key, default = None):
+    """
+    Return the entry for key (and count a hit) or default (a miss).
+    """
+    with self.lock:
+      if key in self.data:
+        self.hits += 1
+        return self[key]
+      self.misses += 1
+      return default
+
+  def peek(self, key, default = None):
+    """
+    Return the entry for key or default, without counting a hit or use.
+    """
+    return self.data.get(key, default)
+
+  def __getitem__(self, key):
+    with self.lock:
+      y = self.data.pop(key)
+      self.data[key] = y
+      self._count(key, self.uses[key] + 1)
+      return y
+
+  def __setitem__(self, key, y):
+    with self.lock:
+      if key in self.data:
+        del self[key]
+      self.data[key] = y
+      self._count(key, 1)
+      self.nbytes += self.size(y)
+      self.evict(key)
+
+  def __delitem__(self, key):
+    with self.lock:
+      self.nbytes -= self.size(self.data.pop(key))
+      self._count(key, None)
+
+  def _count(self, key, n):
+    """
+    Set the number of uses of key to n (None: forget key) and move it to
+    the bucket of n.
+    """
+    c = self.uses.pop(key, None)
+    if c is not None:
+      keys = self.buckets[c]
+      del keys[key]
+      if not keys:
+        del self.buckets[c]
+    if n is not None:
+      self.uses[key] = n
+      self.buckets.setdefault(n, OrderedDict())[key] = None
+      self.lowest = min(self.lowest, n)
+
+  def __contains__(self, key):
+    return key in self.data
+
+  def __len__(self):
+    return len(self.data)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def has_key(self, key):
+    return key in self.data
+
+  def keys(self):
+    return list(self.data.keys())
+
+  def values(self):
+    return list(self.data.values())
+
+  def items(self):
+    return list(self.data.items())
+
+  def clear(self):
+    with self.lock:
+      self.data.clear()
+      self.uses.clear()
+      self.buckets.clear()
+      self.lowest = 0
+      self.nbytes = 0
+
+  def evict(self, keep = None):
+    """
+    Remove entries until the limits are met (but never keep).
+    """
+    with self.lock:
+      while (len(self.data) > self.maxentries or
+             self.nbytes > self.maxbytes) and len(self.data) > 1:
+        del self[self.victim(keep)]
+        self.evictions += 1
+
+  def victim(self, keep = None):
+    """
+    The entry to evict next (not keep): the least recently used one (lru)
+    or the least recently used of the least frequently used ones (lfu).
+    Only looks at the first keys of the data or of the lowest bucket.
+    """
+    keys = self.data
+    if self.policy == 'lfu':
+      if self.lowest not in self.buckets:
+        self.lowest = min(self.buckets)
+      keys = self.buckets[self.lowest]
+      if len(keys) == 1 and keep in keys:
+        keys = self.buckets[min(c for c in self.buckets if c != self.lowest)]
+    for key in keys:
+      if key != keep:
+        return key
+
+  def resize(self, maxbytes = None, maxentries = None, policy = None):
+    """
+    Change the limits or the policy (evicts at once).
+    """
+    if maxbytes is not None: self.maxbytes = maxbytes
+    if maxentries is not None: self.maxentries = maxentries
+    if policy is not None: self.policy = policy
+    self.evict()
+
+  def stats(self):
+    """
+    Counters and sizes as a dict.
+    """
+    return {'entries': len(self.data), 'bytes': self.nbytes,
+            'maxentries': self.maxentries, 'maxbytes': self.maxbytes,
+            'policy': self.policy, 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+ObjCache = RenderCache(gcfg.cachemaxbytes, gcfg.cachemaxentries,
+                       gcfg.cachepolicy)
+def putObj(x, y): ObjCache[objKey(x)] = y
+def getObj(x): return ObjCache[objKey(x)]
+def hasObj(x): return ObjCache.has_key(objKey(x))
 def getPNG(x): return getObj(x).png
-def clearCache(): ObjCache.clear()
+def clearCache():
+  for c in (ObjCache, FailCache, LatexCache, MathCache, MaskCache):
+    c.clear()
+  Tracker.clear()
+
+DviCache = RenderCache(gcfg.dvicachemaxbytes, gcfg.dvicachemaxentries)
+FailCache = RenderCache(gcfg.failcachemaxbytes, gcfg.failcachemaxentries)
+LatexCache = RenderCache(gcfg.latexcachemaxbytes, gcfg.latexcachemaxentries)
+MathCache = RenderCache(gcfg.mathcachemaxbytes, gcfg.mathcachemaxentries)
+MaskCache = RenderCache(gcfg.maskcachemaxbytes, gcfg.maskcachemaxentries)
+
+
+#;;;;;;;;;;;;;;;;;;;;;;;;
+# Render statistics ;;;
+#;;;;;;;;;;;;;;;;;;;;;;;;
+class RenderStats():
+  """
+  Timings of the render stages per backend (TeX0, TeX1, TeX2, ..., the
+  last fs.statssamples samples of seconds and bytes each) and counters of
+  events like cache hits, misses and errors. See %sympyprt stats.
+  """
+
+  def __init__(self, maxlen):
+    self.maxlen = maxlen
+    self.samples = {}
+    self.counts = {}
+    self.lock = threading.Lock()
+
+  def add(self, backend, stage, dt, nbytes = None):
+    """
+    Record dt seconds (and nbytes, e.g. of the png) for a stage.
+    """
+    with self.lock:
+      q = self.samples.get((backend, stage))
+      if q is None:
+        q = self.samples[backend, stage] = deque(maxlen = self.maxlen)
+      q.append((dt, nbytes))
+
+  def count(self, backend, event):
+    with self.lock:
+      self.counts[backend, event] = self.counts.get((backend, event), 0) + 1
+
+  def clear(self):
+    with self.lock:
+      self.samples.clear()
+      self.counts.clear()
+
+  def summary(self):
+    """
+    (backend, stage) -> {n, p50, p95, p99 (seconds), bytes (mean or None)}.
+    """
+    with self.lock:
+      items = [(k, list(q)) for k, q in self.samples.items()]
+    res = {}
+    for k, v in items:
+      t = sorted(x[0] for x in v)
+      b = [x[1] for x in v if x[1] is not None]
+      res[k] = {'n': len(t), 'bytes': sum(b) // len(b) if b else None}
+      for p in (50, 95, 99):
+        res[k]['p%d' % p] = t[min(len(t) - 1, len(t) * p // 100)]
+    return res
+
+  def report(self):
+    """
+    Print the summary (milliseconds) and the counters.
+    """
+    print "{:<8} {:<10} {:>6} {:>9} {:>9} {:>9} {:>9}".format('backend',
+      'stage', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes')
+    for (b, st), r in sorted(self.summary().items()):
+      print "{:<8} {:<10} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9}".format(b, st,
+        r['n'], 1000 * r['p50'], 1000 * r['p95'], 1000 * r['p99'],
+        '' if r['bytes'] is None else r['bytes'])
+    for (b, e), n in sorted(self.counts.items()):
+      print "{:<8} {:<10} {:>6}".format(b, e, n)
+
+  def dump(self, filename):
+    """
+    Write the raw samples and the counters as JSON:
+    {"samples": {backend: {stage: [[seconds, bytes], ...]}},
+     "counts": {backend: {event: n}}}
+    """
+    with self.lock:
+      d = {'samples': {}, 'counts': {}}
+      for (b, st), q in self.samples.items():
+        d['samples'].setdefault(b, {})[st] = [list(x) for x in q]
+      for (b, e), n in self.counts.items():
+        d['counts'].setdefault(b, {})[e] = n
+    f = open(filename, 'w')
+    json.dump(d, f)
+    f.close()
+
+Stats = RenderStats(gcfg.statssamples)
+
+
+def contentKey(*parts):
+  """
+  Hash (hex) of the parts (converted to strings).
+  """
+  return hashlib.sha1(_bytes('\x00'.join('%s' % v for v in parts))).hexdigest()
+
+def renderKey(src, cfg = gcfg):
+  """
+  Content address of an image: hash of the LaTeX code src and all the
+  settings of cfg which affect the pixels.
+  """
+  return contentKey(src, *pixels(cfg))
+
+def svgKey(src, cfg = gcfg):
+  """
+  Content address of an SVG image (see renderKey).
+  """
+  return contentKey('svg', src, cfg.fontsize, cfg.forecolor, cfg.backcolor,
+    cfg.mode, cfg.matrix, cfg.breqn, cfg.preamble)
+
+def dviKey(src, cfg = gcfg):
+  """
+  Key of the dvi file of src in DviCache (only the settings used by latex).
+  """
+  return contentKey('dvi', src, cfg.fontsize, cfg.preamble)
+
+def maskKey(src, cfg = gcfg):
+  """
+  Key of the coverage mask of src in MaskCache (renderKey without colors).
+  """
+  return contentKey('mask', src, cfg.fontsize, cfg.resolution, cfg.imagesize,
+    cfg.offset, cfg.mode, cfg.matrix, cfg.breqn, cfg.preamble)
+
+def texKey(obj, *settings):
+  """
+  Key of the LaTeX code of the sympy object obj in LatexCache: its type,
+  its (structural) hash and the printer settings. The entry holds the
+  object (weakly if possible) for the check (see LatexEntry). None
+  if obj is not hashable (e.g. a mutable Matrix).
+  """
+  try:
+    return (type(obj), hash(obj)) + settings
+  except TypeError:
+    return None
+
+def objKey(x, cfg = gcfg):
+  """
+  The cache key of the sympy object x (see renderKey).
+  """
+  return renderKey(texSource(x, cfg), cfg)
+
+
+class DiskCache():
+  """
+  Images on disk: root/<key[:2]>/<key[2:]>.png (or .svg). Files are written to
+  a temp file and renamed (atomic), a hit touches the file and the
+  garbage collector removes the least recently used files when the total
+  size exceeds maxbytes. Several processes may share the directory.
+  """
+
+  def __init__(self, root, maxbytes):
+    self.root = root
+    self.maxbytes = maxbytes
+    self.written = maxbytes # => collect on first put
+    self.hits = self.misses = self.writes = 0
+
+  def path(self, key, ext = '.png'):
+    return os.path.join(self.root, key[:2], key[2:] + ext)
+
+  def get(self, key, ext = '.png'):
+    """
+    Return the PNG image (ext .png) or the SVG text (.svg) for key or None.
+    """
+    try:
+      path = self.path(key, ext)
+      f = open(path, 'rb')
+      data = f.read()
+      f.close()
+      if data[:8] == b'\x89PNG\r\n\x1a\n' or (ext == '.svg' and
+                                              b'</svg>' in data[-16:]):
+        os.utime(path, None)
+        self.hits += 1
+        return data if ext == '.png' else _text(data)
+    except (IOError, OSError):
+      pass
+    self.misses += 1
+    return None
+
+  def put(self, key, data, ext = '.png'):
+    """
+    Store the PNG image or SVG text for key.
+    """
+    if not data:
+      return
+    png = _bytes(data)
+    path = self.path(key, ext)
+    try:
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+      pass # made by another process
+    try:
+      fd, tmp = tempfile.mkstemp(suffix = '.tmp', dir = os.path.dirname(path))
+      os.write(fd, png)
+      os.close(fd)
+      try:
+        os.rename(tmp, path)
+      except OSError: # NT: exists already
+        os.remove(tmp)
+    except (IOError, OSError):
+      return
+    self.writes += 1
+    self.written += len(png)
+    if self.written > self.maxbytes // 10:
+      self.gc()
+
+  def files(self):
+    """
+    List of (atime, size, path) of all images.
+    """
+    out = []
+    for d, dirs, names in os.walk(self.root):
+      for n in names:
+        if n.endswith(('.png', '.svg')):
+          p = os.path.join(d, n)
+          try:
+            st = os.stat(p)
+            out.append((st.st_mtime, st.st_size, p))
+          except OSError:
+            pass
+    return out
+
+  def gc(self):
+    """
+    Remove the least recently used images until the total size is below
+    80% of maxbytes. Skipped if another process is collecting.
+    """
+    self.written = 0
+    lock = None
+    try:
+      import fcntl
+      lock = open(os.path.join(self.root, '.gc.lock'), 'w')
+      fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except ImportError:
+      pass # NT: no locking
+    except (IOError, OSError):
+      if lock is not None:
+        lock.close()
+      return
+    try:
+      files = sorted(self.files())
+      total = sum(f[1] for f in files)
+      for mtime, size, path in files:
+        if total <= self.maxbytes * 0.8:
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        total -= size
+    finally:
+      if lock is not None:
+        lock.close()
+
+  def clear(self):
+    """
+    Remove all images.
+    """
+    for mtime, size, path in self.files():
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def stats(self):
+    """
+    Counters and size as a dict.
+    """
+    return {'diskhits': self.hits, 'diskmisses': self.misses,
+            'diskwrites': self.writes,
+            'diskbytes': sum(f[1] for f in self.files()),
+            'diskmaxbytes': self.maxbytes}
+
+_diskcaches = {}
+
+def getDiskCache(root = None, maxbytes = None):
+  """
+  The DiskCache for the directory root (default fs.diskcachedir). Used by
+  texprt and ipy_tex too.
+  """
+  root = root or gcfg.diskcachedir
+  if root not in _diskcaches:
+    _diskcaches[root] = DiskCache(root, maxbytes or gcfg.diskcachemaxbytes)
+  elif maxbytes:
+    _diskcaches[root].maxbytes = maxbytes
+  return _diskcaches[root]
+
+def diskCache(cfg = gcfg):
+  """
+  The DiskCache for cfg or None if the disk cache is off.
+  """
+  if not cfg.diskcache:
+    return None
+  return getDiskCache(cfg.diskcachedir, cfg.diskcachemaxbytes)
 
 
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
@@ -216,12 +997,17 @@ def clearCache(): ObjCache.clear()
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 
 fs.magic_help_text =\
-"""Usage: %sympyprt on | off | help | use ?m | ?p ?v
+"""Usage: %sympyprt on | off | help | stats | use ?m | ?p ?v
  ?m : method
   simple ...... use IPython's latex_to_png method (no options)
   mplib ....... use matplotlib (options: fontsize, textcolor, resolution)
   latex ....... use LaTeX/dvipng. Options are: fontsize, textcolor,
                 resolution, imagesize, backcolor and offset.
+  svg ......... use LaTeX/dvisvgm (scalable, options: fontsize, textcolor
+                and backcolor).
+  auto ........ mplib or latex per formula: what mathtext can't render goes
+                to latex, the rest to the cheapest method (measured, see
+                %sympyprt cache stats).
 
  ?p : parameter, ?v : value
   fontsize .... set the fontsize (unit: pt), ?v:Integer (default 11)
@@ -236,6 +1022,28 @@ fs.magic_help_text =\
   mode ........ ?v : inline|equation|equation*
   matrix ...... matrix type: ?v : p|v|b|V|B|small (as in LaTeX: ?v-matrix)
   breqn ....... use the breqn package: ?v : on|off
+  worker ...... use a persistent latex process: ?v : on|off|restart
+  workers ..... number of render threads: ?v:Integer (0: no threads)
+  async ....... show a placeholder and update it when rendered: ?v : on|off
+  placeholder . the placeholder of async: ?v : pretty|mplib
+  recolor ..... color changes colorize the kept masks: ?v : on|off
+  purge ....... drop the cache entries of collected objects: ?v : on|off
+  budget ...... don't render formulas costing more: ?v:Integer (0: no limit)
+  overbudget .. show such formulas: ?v : text|truncate|defer
+  timeout ..... kill a latex/dvipng run after ?v seconds (0: never)
+  fallback .... show formulas latex failed on with: ?v : mplib|text
+  fmt ......... use precompiled preambles (format files): ?v : on|off|clear
+  cache ....... ?v : stats|clear|redraw|maxbytes ?n|maxentries ?n|policy lru|lfu
+                (clear and redraw also retry the formulas which failed)
+                redraw fresh: run latex again (e.g. after a TeX update)
+                (?n may end with k, M or G, e.g. %sympyprt cache maxbytes 64M)
+                disk on|off|clear|gc, diskmaxbytes ?n: the on-disk cache
+                (fs.diskcachedir) shared by kernels.
+                dvi on|off|clear: the latex output (a color, resolution or
+                size change reruns dvipng only).
+                purge: remove the images of other settings (stats: stale).
+  stats ....... timings per backend and stage (p50/p95/p99, bytes) and
+                cache hits/misses; ?v : clear|json ?file (raw samples)
   reset ....... ?v : config|cache;
                 config: reset the global cfg (gcfg) to factory settings (fs).
                 cache: clear the cache
@@ -256,8 +1064,10 @@ def _fswitch(arg):
     gcfg._active = False
   elif arg == 'help':
     print fs.magic_help_text
+  elif arg == 'stats':
+    _fstats()
   else:
-    print 'Usage: %s on|off|help|use ?m|?p ?v' % ('%' + gcfg._magic)
+    print 'Usage: %s on|off|help|stats|use ?m|?p ?v' % ('%' + gcfg._magic)
     print 'Current state: %s' % d[gcfg._active]
 
 #
@@ -295,6 +1105,46 @@ def _fparams(p, v):
     d = {'on':True, 'off':False}
     if v  in d.keys():
       gcfg.breqn = d[v]
+  elif p == 'worker':
+    d = {'on':True, 'off':False}
+    if v in d.keys():
+      gcfg.worker = d[v]
+    elif v == 'restart':
+      stopWorkers()
+  elif p == 'workers':
+    gcfg.workers = int(v)
+    Renderer.resize(gcfg.workers)
+  elif p == 'async':
+    d = {'on':True, 'off':False}
+    if v in d.keys():
+      setAsync(d[v])
+  elif p == 'placeholder':
+    if v in ('pretty', 'mplib'):
+      gcfg.placeholder = v
+  elif p == 'recolor':
+    d = {'on':True, 'off':False}
+    if v in d.keys():
+      gcfg.recolor = d[v]
+  elif p == 'purge':
+    d = {'on':True, 'off':False}
+    if v in d.keys():
+      gcfg.purge = d[v]
+  elif p == 'fallback':
+    if v in ('mplib', 'text'):
+      gcfg.fallback = v
+  elif p == 'budget':
+    gcfg.budget = int(v)
+  elif p == 'overbudget':
+    if v in ('text', 'truncate', 'defer'):
+      gcfg.overbudget = v
+  elif p == 'timeout':
+    gcfg.rendertimeout = float(v)
+  elif p == 'fmt':
+    d = {'on':True, 'off':False}
+    if v in d.keys():
+      gcfg.fmt = d[v]
+    elif v == 'clear':
+      clearFormats()
   elif p == 'show':
     if v in paramap(gcfg).keys():
       print paramap(gcfg)[v]
@@ -303,6 +1153,10 @@ def _fparams(p, v):
         print "{:<12} ....... {}".format(s, paramap(gcfg)[s])
     else:
       print fs.magic_help_text
+  elif p == 'cache':
+    _fcache(v)
+  elif p == 'stats':
+    _fstats(v)
   elif p == 'reset':
     if v == 'config':
       gfcg = fs()
@@ -312,6 +1166,80 @@ def _fparams(p, v):
     print 'Usage: %s %s ?value' % (('%' + gcfg._magic), '|'.join(gcfg._params))
 
 
+#
+# Function to show/set the image cache parameters
+#
+def _fcache(p, v = None):
+  m = {'k': 1024, 'M': 1024**2, 'G': 1024**3}
+  try:
+    if p == 'stats':
+      st = ObjCache.stats()
+      dvi = DviCache.stats()
+      fail = FailCache.stats()
+      tex = LatexCache.stats()
+      math = MathCache.stats()
+      mask = MaskCache.stats()
+      for s in ('bytes', 'entries', 'hits', 'misses', 'evictions'):
+        st['dvi' + s] = dvi[s]
+        st['fail' + s] = fail[s]
+        st['latex' + s] = tex[s]
+        st['math' + s] = math[s]
+        st['mask' + s] = mask[s]
+      if diskCache() is not None:
+        st.update(diskCache().stats())
+      for m, c in Costs.stats().items():
+        st[m + 'cost'] = c
+      st['stale'] = len(staleKeys())
+      for s in sorted(st.keys()):
+        print "{:<14} ....... {}".format(s, st[s])
+    elif p == 'clear':
+      clearCache()
+    elif p == 'redraw':
+      redrawCache(v == 'fresh')
+    elif p == 'purge':
+      for k in staleKeys():
+        del ObjCache[k]
+    elif p == 'dvi' and v in ('on', 'off'):
+      gcfg.dvicache = v == 'on'
+    elif p == 'dvi' and v == 'clear':
+      DviCache.clear()
+    elif p == 'maxbytes' and v is not None:
+      gcfg.cachemaxbytes = int(v[:-1]) * m[v[-1]] if v[-1] in m else int(v)
+      ObjCache.resize(maxbytes = gcfg.cachemaxbytes)
+    elif p == 'maxentries' and v is not None:
+      gcfg.cachemaxentries = int(v)
+      ObjCache.resize(maxentries = gcfg.cachemaxentries)
+    elif p == 'policy' and v in ('lru', 'lfu'):
+      gcfg.cachepolicy = v
+      ObjCache.resize(policy = v)
+    elif p == 'disk' and v in ('on', 'off'):
+      gcfg.diskcache = v == 'on'
+    elif p == 'disk' and v in ('clear', 'gc'):
+      getattr(getDiskCache(), v)()
+    elif p == 'diskmaxbytes' and v is not None:
+      gcfg.diskcachemaxbytes = int(v[:-1]) * m[v[-1]] if v[-1] in m else int(v)
+      getDiskCache().maxbytes = gcfg.diskcachemaxbytes
+    else:
+      raise ValueError(p)
+  except ValueError:
+    print 'Usage: %s cache stats|clear|redraw|purge|maxbytes ?n|maxentries ?n' %\
+      ('%' + gcfg._magic)
+    print '       %s cache policy lru|lfu|dvi on|off|clear' % ('%' + gcfg._magic)
+    print '       %s cache disk on|off|clear|gc|diskmaxbytes ?n' %\
+      ('%' + gcfg._magic)
+
+
+def _fstats(p = None, v = None):
+  if p is None:
+    Stats.report()
+  elif p == 'clear':
+    Stats.clear()
+  elif p == 'json' and v is not None:
+    Stats.dump(v)
+  else:
+    print 'Usage: %s stats [clear|json ?file]' % ('%' + gcfg._magic)
+
+
 def _fmagic(self, *args):
   a = args[0].split()
   l = len(a)
@@ -324,6 +1252,10 @@ def _fmagic(self, *args):
       _fmethod(a[1])
     else:
       _fparams(a[0], a[1])
+  elif l == 3 and a[0] == 'cache':
+    _fcache(a[1], a[2])
+  elif l == 3 and a[0] == 'stats':
+    _fstats(a[1], a[2])
 
 
 #;;;;;;;;;;;;;;;
@@ -348,7 +1280,9 @@ class TeX0():
   Render TeX code with IPython lib latextools (not many options here ;)
   """
   def __init__(self, s, encode = False):
+    t = time.time()
     self.png = latex_to_png(s, encode)
+    Stats.add('TeX0', 'total', time.time() - t, len(self.png or b''))
   def _repr_png_(self):
     return self.png
 
@@ -364,7 +1298,7 @@ class TeX1():
   """
   def __init__(self, src, encode = False, cfg = fs()):
 
-    self.cfg = copy(cfg)
+    self.cfg = snapshot(cfg)
     self.src = src
     self.encode = encode
     self.png = None
@@ -373,118 +1307,1298 @@ class TeX1():
       self.render(self.cfg)
 
   def render(self, cfg):
-    self.mtp = MathTextParser('bitmap')
-    f = StringIO()
-    self.mtp.to_png(f, self.src, cfg.forecolor, cfg.resolution, cfg.fontsize)
-    bin_data = f.getvalue()
+    bin_data = mathPNG(self.src, cfg.forecolor, cfg.resolution, cfg.fontsize)
     if self.encode:
       bin_data = encodestring(bin_data)
     self.png = bin_data
-    f.close()
 
   def _repr_png_(self):
     return self.png
 
 
-#;;;;;;;;;;;;;;;
-# Class TeX2 ;;;
-#;;;;;;;;;;;;;;;
-class TeX2():
+# Idle mathtext parsers (a parser is not thread safe, but keeps its parse
+# cache and the fonts warm => reuse them)
+_parsers = []
+_parsers_lock = threading.Lock()
+
+def getParser():
   """
-  Convert TeX code to a PNG image via dvi using the 'dvipng' command.
-  Credit: dvipng 1.XX Copyright 2002-2008 Jan-Ake Larsson
-  Details: http://www.nongnu.org/dvipng/dvipng_4.html
-  -- This is by far the shortest and fastest version (compared to older TeX2).
+  Check out an idle MathTextParser (a new one if all are busy). Give it
+  back with putParser.
   """
+  with _parsers_lock:
+    if _parsers:
+      return _parsers.pop()
+  return MathTextParser('bitmap')
 
-  def __init__(self, src, cfg = gcfg):
-    """
-    The parameter src should be TeX code without preamble and without begin/end
-    document commands. The optional parameter cfg can be a modified instance
-    of the factory settings class fs.
-    """
+def putParser(p):
+  """
+  Return a parser checked out by getParser.
+  """
+  with _parsers_lock:
+    _parsers.append(p)
 
-    # Copy cfg (otherwise changes to cfg affect the whole class)
-    self.cfg = copy(cfg)
-    self.src = src
+def mathPNG(src, color, dpi, fontsize):
+  """
+  The mathtext PNG of src, memoized in MathCache. The mask of src is kept
+  in MaskCache, so another color only colorizes it. Raises ValueError on
+  parse errors (not memoized).
+  """
+  key = contentKey('mathtext', src, color, dpi, fontsize)
+  png = MathCache.get(key)
+  if png is not None:
+    Stats.count('TeX1', 'hit')
+    return png
+  t0 = time.time()
+  mkey = contentKey('mathmask', src, dpi, fontsize)
+  mask = MaskCache.get(mkey)
+  p = getParser() if mask is None else None
+  try:
+    if p is not None and hasattr(p, 'to_mask'):
+      mask = p.to_mask(src, dpi, fontsize)[0]
+      MaskCache[mkey] = mask
+      Stats.add('TeX1', 'mathtext', time.time() - t0)
+    if mask is not None:
+      t = time.time()
+      png = colorize(mask, to_rgb(color), None, True)
+      Stats.add('TeX1', 'encode', time.time() - t)
+    else:
+      f = BytesIO()
+      p.to_png(f, src, color, dpi, fontsize)
+      png = f.getvalue()
+      f.close()
+      Stats.add('TeX1', 'mathtext', time.time() - t0)
+  finally:
+    if p is not None:
+      putParser(p)
+  MathCache[key] = png
+  Stats.add('TeX1', 'total', time.time() - t0, len(png))
+  return png
 
-    # Log (subprocess/communicate output in case of errors)
-    self.log = None
 
-    # The PNG file
-    self.pngfile = None
+#;;;;;;;;;;;;;;;;;;;;;;;;
+# Colors and masks ;;;
+#;;;;;;;;;;;;;;;;;;;;;;;;
+# The named colors of dvipng (dvipsnam.def, cmyk)
+_DVIPSNAMES = """
+GreenYellow 0.15 0 0.69 0; Yellow 0 0 1 0; Goldenrod 0 0.10 0.84 0;
+Dandelion 0 0.29 0.84 0; Apricot 0 0.32 0.52 0; Peach 0 0.50 0.70 0;
+Melon 0 0.46 0.50 0; YellowOrange 0 0.42 1 0; Orange 0 0.61 0.87 0;
+BurntOrange 0 0.51 1 0; Bittersweet 0 0.75 1 0.24; RedOrange 0 0.77 0.87 0;
+Mahogany 0 0.85 0.87 0.35; Maroon 0 0.87 0.68 0.32; BrickRed 0 0.89 0.94 0.28;
+Red 0 1 1 0; OrangeRed 0 1 0.50 0; RubineRed 0 1 0.13 0;
+WildStrawberry 0 0.96 0.39 0; Salmon 0 0.53 0.38 0; CarnationPink 0 0.63 0 0;
+Magenta 0 1 0 0; VioletRed 0 0.81 0 0; Rhodamine 0 0.82 0 0;
+Mulberry 0.34 0.90 0 0.02; RedViolet 0.07 0.90 0 0.34; Fuchsia 0.47 0.91 0 0.08;
+Lavender 0 0.48 0 0; Thistle 0.12 0.59 0 0; Orchid 0.32 0.64 0 0;
+DarkOrchid 0.40 0.80 0.20 0; Purple 0.45 0.86 0 0; Plum 0.50 1 0 0;
+Violet 0.79 0.88 0 0; RoyalPurple 0.75 0.90 0 0; BlueViolet 0.86 0.91 0 0.04;
+Periwinkle 0.57 0.55 0 0; CadetBlue 0.62 0.57 0.23 0; CornflowerBlue 0.65 0.13 0 0;
+MidnightBlue 0.98 0.13 0 0.43; NavyBlue 0.94 0.54 0 0; RoyalBlue 1 0.50 0 0;
+Blue 1 1 0 0; Cerulean 0.94 0.11 0 0; Cyan 1 0 0 0; ProcessBlue 0.96 0 0 0;
+SkyBlue 0.62 0 0.12 0; Turquoise 0.85 0 0.20 0; TealBlue 0.86 0 0.34 0.02;
+Aquamarine 0.82 0 0.30 0; BlueGreen 0.85 0 0.33 0; Emerald 1 0 0.50 0;
+JungleGreen 0.99 0 0.52 0; SeaGreen 0.69 0 0.50 0; Green 1 0 1 0;
+ForestGreen 0.91 0 0.88 0.12; PineGreen 0.92 0 0.59 0.25; LimeGreen 0.50 0 1 0;
+YellowGreen 0.44 0 0.74 0; SpringGreen 0.26 0 0.76 0;
+OliveGreen 0.64 0 0.95 0.40; RawSienna 0 0.72 1 0.45; Sepia 0 0.83 1 0.70;
+Brown 0 0.81 1 0.60; Tan 0.14 0.42 0.56 0; Gray 0 0 0 0.50; Black 0 0 0 1;
+White 0 0 0 0"""
+_dvipsnames = dict((v[0].lower(), 'cmyk ' + ' '.join(v[1:])) for v in
+                   (c.split() for c in _DVIPSNAMES.split(';')))
+
+def texColor(c):
+  """
+  The rgb triple (0..1) of the dvipng color c (a dvips name like Blue,
+  rgb 1 0 0, gray 0.5 or cmyk 0 1 1 0). None if c is Transparent or not
+  known.
+  """
+  v = _dvipsnames.get(c.lower(), c).split()
+  try:
+    if v[0] == 'rgb' and len(v) == 4:
+      return tuple(float(x) for x in v[1:])
+    if v[0] == 'gray' and len(v) == 2:
+      return (float(v[1]),) * 3
+    if v[0] == 'cmyk' and len(v) == 5:
+      cmyk = [float(x) for x in v[1:]]
+      return tuple(1 - min(1, x + cmyk[3]) for x in cmyk[:3])
+  except ValueError:
+    pass
+  return None
 
-    # The PNG image (string/x89PNG)
-    self.png = None
+def texColors(cfg):
+  """
+  The rgb triples (foreground, background) of cfg (background None if
+  Transparent) or None if a color is not known.
+  """
+  fg, bg = texColor(cfg.forecolor), texColor(cfg.backcolor)
+  if fg is None or (bg is None and cfg.backcolor.lower() != 'transparent'):
+    return None
+  return fg, bg
 
-    # Render now or later?
-    if cfg.initrender:
-      self.render(self.cfg)
+def pngMask(png, fg, bg = None):
+  """
+  The coverage mask (uint8 array, 255 = foreground) of a png rendered
+  with the rgb colors fg on bg (None: transparent). None if the colors
+  can't be told apart.
+  """
+  img = imread(BytesIO(png), format = 'png')
+  if img.ndim == 2:
+    img = img[..., None]
+  rgb = img[..., :3] if img.shape[2] >= 3 else img[..., :1].repeat(3, 2)
+  a = img[..., -1] if img.shape[2] in (2, 4) else 1
+  ref = np.array(bg if bg is not None else (1.0, 1.0, 1.0))
+  d = np.array(fg) - ref
+  n = d.dot(d)
+  if n > 1e-3:
+    cov = np.clip((rgb - ref).dot(d) / n, 0, 1) * a
+  elif bg is None and img.shape[2] in (2, 4):
+    cov = a # fg = white on transparent
+  else:
+    return None
+  return np.round(cov * 255).astype(np.uint8)
 
+def colorize(mask, fg, bg = None, trunc = False):
+  """
+  Encode the mask as png with the rgb colors fg on bg (None: transparent,
+  the mask is the alpha channel). trunc: truncate the color values like
+  mathtext does.
+  """
+  f = np.array(fg) * 255
+  f = np.floor(f) if trunc else np.round(f)
+  if bg is None:
+    img = np.empty(mask.shape + (4,), np.uint8)
+    img[..., :3] = f
+    img[..., 3] = mask
+  else:
+    b = np.round(np.array(bg) * 255)
+    lut = np.round(b + (f - b) * (np.arange(256)[:, None] / 255.0))
+    img = lut.astype(np.uint8)[mask]
+  return encodePNG(img)
 
-  def render(self, cfg):
-    """
-    Run latex then convert the dvi output to png. The mandatory cfg
-    has to be an instance of fs (usually self.cfg).
-    """
-    # Default template
-    self.preamble = cfg.preamble % (cfg.fontsize, self.src)
+def _chunk(t, d):
+  return struct.pack('>I', len(d)) + t + d + \
+         struct.pack('>I', zlib.crc32(t + d) & 0xffffffff)
 
-    # LaTeX command
-    self.latex = cfg.latexcmd.format(cfg.latex)
+def encodePNG(img):
+  """
+  Encode an rgb or rgba uint8 array (height, width, 3|4) as png.
+  """
+  h, w, c = img.shape
+  raw = np.zeros((h, w * c + 1), np.uint8) # filter byte 0 on each row
+  raw[:, 1:] = img.reshape(h, w * c)
+  ihdr = struct.pack('>IIBBBBB', w, h, 8, 6 if c == 4 else 2, 0, 0, 0)
+  return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', ihdr) + \
+         _chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + _chunk(b'IEND', b'')
+
+
+#;;;;;;;;;;;;;;;;;;;
+# Format files ;;;
+#;;;;;;;;;;;;;;;;;;;
+_BEGIN = '\\begin{document}'
+_FMTERR = re.compile(r"Fatal format file error|can't find the format|"
+                     r"was written by")
+
+# Known formats: name -> True (dumped) | False (dump failed)
+_formats = {}
+_formats_lock = threading.Lock()
+
+def splitDocument(cfg, src = ''):
+  """
+  Split the document of src into the preamble (before \\begin{document})
+  and the rest. The preamble is empty if there is no \\begin{document}.
+  """
+  doc = cfg.preamble % (cfg.fontsize, src)
+  k = doc.find(_BEGIN)
+  if k < 0:
+    return '', doc
+  return doc[:k], doc[k:]
 
-    # Dvipng command
-    self.dvipng = cfg.dvipngcmd.format(cfg.dvipng, cfg.imagesize,
-      cfg.resolution, cfg.backcolor, cfg.forecolor, cfg.offset,
-      cfg.pngfile, cfg.dvifile)
+def formatFile(cfg):
+  """
+  Return the format file (path without .fmt, named after cfg._magic, so
+  texprt's are its own) for the preamble of cfg and dump it on first use.
+  None if formats are off or the dump failed.
+  """
+  if not cfg.fmt:
+    return None
+  pre = splitDocument(cfg)[0]
+  if not pre:
+    return None
+  key = '\n'.join((cfg.latex, cfg.fmtbase, pre))
+  name = cfg._magic + '-' + hashlib.sha1(_bytes(key)).hexdigest()[:16]
+  path = os.path.join(cfg.fmtdir, name)
+  with _formats_lock:
+    if _formats.get(name) is False or not privateDir(cfg.fmtdir):
+      return None
+    if not os.path.exists(path + '.fmt'):
+      _formats[name] = dumpFormat(pre, name, cfg)
+    else:
+      _formats[name] = True
+  return path if _formats[name] else None
 
-    # Note: going to write to latex's stdin => needs to be piped
-    p = Popen(self.latex, shell = True, stdin = PIPE, stdout = PIPE)
+def privateDir(path):
+  """
+  Create the directory path (mode 0700) if needed. True if it is private:
+  owned by the user and not accessible by others (POSIX), so nobody else
+  can plant format files in it.
+  """
+  try:
+    if not os.path.isdir(path):
+      os.makedirs(path, 0o700)
+    if not hasattr(os, 'getuid'):
+      return True
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+  except OSError:
+    return False
 
-    # Send input & read stdout/stderr
-    log = p.communicate(cfg.preamble % (cfg.fontsize, self.src))
+def dumpFormat(pre, name, cfg):
+  """
+  Dump the preamble pre as format fs.fmtdir/name.fmt. The dump runs in
+  a private directory and is moved into place, so several processes may
+  dump the same format at once.
+  """
+  tmp = None
+  try:
+    tmp = tempfile.mkdtemp(prefix = 'dump-', dir = cfg.fmtdir)
+    f = open(os.path.join(tmp, name + '.tex'), 'wb')
+    f.write(_bytes(pre + '\\dump\n'))
+    f.close()
+    p = spawn(cfg.fmtcmd.format(cfg.latex, name, cfg.fmtbase),
+      stdin = PIPE, stdout = PIPE, stderr = STDOUT, cwd = tmp)
+    communicate(p, None, cfg.rendertimeout)
+    fmt = os.path.join(tmp, name + '.fmt')
+    if p.returncode != 0 or not os.path.exists(fmt):
+      return False
+    try:
+      os.rename(fmt, os.path.join(cfg.fmtdir, name + '.fmt'))
+    except OSError:
+      pass # NT: already dumped by someone else
+    return True
+  except (IOError, OSError):
+    return False
+  finally:
+    if tmp is not None:
+      shutil.rmtree(tmp, True)
+
+def dropFormat(fmt):
+  """
+  Remove a stale format file (e.g. after a TeX update) and don't use it
+  again in this session.
+  """
+  with _formats_lock:
+    _formats[os.path.basename(fmt)] = False
+    try:
+      os.remove(fmt + '.fmt')
+    except OSError:
+      pass
 
-    # Check for errors (<>0)
-    if  p.returncode != 0:
-      print cfg.errlatex
-      self.log = log
-      self.cleanup()
-      return
+def clearFormats():
+  """
+  Remove all format files, they are dumped again on next use.
+  """
+  stopWorkers()
+  with _formats_lock:
+    _formats.clear()
+    if os.path.isdir(gcfg.fmtdir):
+      for f in os.listdir(gcfg.fmtdir):
+        if f.startswith(gcfg._magic + '-') and f.endswith('.fmt'):
+          try:
+            os.remove(os.path.join(gcfg.fmtdir, f))
+          except OSError:
+            pass
+
+
+#;;;;;;;;;;;;;;;;;;;;;;;;;
+# DVI page extraction ;;;
+#;;;;;;;;;;;;;;;;;;;;;;;;;
+
+def _dviargs():
+  """
+  Number of fixed argument bytes of each dvi opcode (xxx and fnt_def
+  have variable length and are handled separately).
+  """
+  t = [0] * 256
+  for op in (128, 133, 143, 148, 153, 157, 162, 167, 235):
+    for k in range(4):
+      t[op + k] = k + 1
+  t[132] = t[137] = 8 # set_rule, put_rule
+  t[139] = 44         # bop
+  return t
 
-    # Run the dvi to png conversion
-    p = Popen(self.dvipng, shell = True, stdout = PIPE)
+_DVIARGS = _dviargs()
 
-    # Read stdout/stderr
-    log = p.communicate()
 
-    # Check for errors (<>0)
+def _uint(b, i, n):
+  """
+  Read an unsigned big endian integer of n bytes from bytearray b at i.
+  """
+  v = 0
+  for k in range(n):
+    v = (v << 8) | b[i + k]
+  return v
+
+
+class DviFile():
+  """
+  Incremental reader for the dvi file of a TeXWorker. Complete pages are
+  collected (by \\count0) as soon as they are on disk and each one can be
+  written out as a standalone dvi file for dvipng.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.pos = 0       # file offset of the first unparsed byte
+    self.pre = None    # preamble bytes
+    self.fonts = []    # fnt_def commands in order of appearance
+    self.pages = {}    # count0 -> (bop counters, page body, stack depth)
+
+  def update(self):
+    """
+    Parse all complete pages written since the last call.
+    """
+    try:
+      f = open(self.path, 'rb')
+    except IOError:
+      return
+    f.seek(self.pos)
+    b = bytearray(f.read())
+    f.close()
+    self.feed(b)
+
+  def feed(self, b):
+    """
+    Parse the bytearray b (the file from self.pos on).
+    """
+    i = 0
+    if self.pre is None:
+      if len(b) < 15 or len(b) < 15 + b[14]:
+        return
+      self.pre = bytes(b[:15 + b[14]])
+      i = len(self.pre)
+    while i < len(b):
+      op = b[i]
+      if op == 138: # nop
+        i += 1
+      elif 243 <= op <= 246: # fnt_def between pages
+        j = self._fntdef(b, i)
+        if j is None: break
+        self.fonts.append(bytes(b[i:j]))
+        i = j
+      elif op == 139: # bop
+        j = self._page(b, i)
+        if j is None: break
+        i = j
+      else: # post or garbage: stop reading
+        break
+    self.pos += i
+
+  def _fntdef(self, b, i):
+    """
+    End of the fnt_def at i or None if incomplete.
+    """
+    k = b[i] - 242
+    j = i + 1 + k + 12
+    if j + 2 > len(b):
+      return None
+    j += 2 + b[j] + b[j + 1]
+    if j > len(b):
+      return None
+    return j
+
+  def _page(self, b, i):
+    """
+    Parse the page starting with the bop at i. Returns the offset after
+    the eop or None if the page is incomplete.
+    """
+    if i + 45 > len(b):
+      return None
+    counts = bytes(b[i + 1:i + 41])
+    body = bytearray()
+    fonts = []
+    depth = maxdepth = 0
+    j = i + 45
+    while j < len(b):
+      op = b[j]
+      if op == 140: # eop
+        self.fonts.extend(fonts)
+        c0 = struct.unpack('>i', counts[:4])[0]
+        if c0 > 0 and c0 not in self.pages:
+          self.pages[c0] = (counts, bytes(body), maxdepth)
+        return j + 1
+      elif 239 <= op <= 242: # xxx
+        n = op - 238
+        if j + 1 + n > len(b): return None
+        e = j + 1 + n + _uint(b, j + 1, n)
+      elif 243 <= op <= 246: # fnt_def
+        e = self._fntdef(b, j)
+        if e is None: return None
+        fonts.append(bytes(b[j:e]))
+        j = e
+        continue
+      else:
+        if op == 141:
+          depth += 1
+          maxdepth = max(depth, maxdepth)
+        elif op == 142:
+          depth -= 1
+        e = j + 1 + _DVIARGS[op]
+      if e > len(b):
+        return None
+      body += b[j:e]
+      j = e
+    return None
+
+  def add(self, dvi, c0):
+    """
+    Add the (first) page of the standalone dvi as page c0. Returns False if
+    its font numbers clash with the fonts of this file.
+    """
+    d = DviFile(None)
+    d.feed(bytearray(dvi))
+    if not d.pages:
+      return False
+    fonts = dict((_fontnum(f), f) for f in self.fonts)
+    for f in d.fonts:
+      if fonts.get(_fontnum(f), f) != f:
+        return False
+    self.pre = self.pre or d.pre
+    self.fonts.extend(f for f in d.fonts if _fontnum(f) not in fonts)
+    self.pages[c0] = d.pages[min(d.pages)]
+    return True
+
+  def document(self, c0s, keep = False):
+    """
+    Return the pages with \\count0 in c0s (in this order) as a standalone
+    dvi. The pages are removed from the reader unless keep is True.
+    """
+    pre = bytearray(self.pre)
+    fonts = b''.join(self.fonts)
+    out = bytearray(self.pre)
+    bop = -1
+    depth = 0
+    for c0 in c0s:
+      counts, body, d = self.pages[c0] if keep else self.pages.pop(c0)
+      depth = max(d, depth)
+      last = len(out)
+      out += b'\x8b' + counts + struct.pack('>i', bop) + fonts + body + b'\x8c'
+      bop = last
+    post = len(out)
+    out += b'\xf8' + struct.pack('>i', bop) + bytes(pre[2:14])
+    out += struct.pack('>iiHH', 0, 0, depth, len(c0s)) + fonts
+    out += b'\xf9' + struct.pack('>i', post) + bytes(pre[1:2])
+    out += b'\xdf' * (4 + (-len(out) - 4) % 4)
+    return bytes(out)
+
+  def page(self, c0):
+    """
+    Return the page with \\count0 = c0 as a standalone dvi (or None).
+    """
+    if self.pre is None or c0 not in self.pages:
+      return None
+    return self.document([c0])
+
+
+def _fontnum(f):
+  """
+  The font number of the fnt_def command f.
+  """
+  b = bytearray(f)
+  return _uint(b, 1, b[0] - 242)
+
+def pageSource(n, src):
+  """
+  TeX code to typeset src on its own page with \\count0 = n (the group
+  keeps local definitions of src away from the following pages).
+  """
+  return ('\\setcounter{page}{%d}\\begingroup\n%s\n\\endgroup\\clearpage'
+          % (n, src))
+
+
+#;;;;;;;;;;;;;;;;;;;;;
+# Class TeXWorker ;;;
+#;;;;;;;;;;;;;;;;;;;;;
+class TeXWorker():
+  """
+  A long-lived latex process. The document head (everything up to and
+  including \\begin{document}) is loaded once, then each formula passed
+  to typeset_many() is shipped out as a new page of the same dvi file.
+  The pages are read back by a DviFile. A crashed or hanging worker is
+  killed and restarted with the next request.
+  """
+
+  def __init__(self, head, fmt = None, cfg = gcfg):
+    """
+    The parameter head is the expanded preamble up to \\begin{document}
+    (only \\begin{document} if the preamble is in the format file fmt).
+    """
+    self.head = head
+    self.fmt = fmt
+    self.cfg = snapshot(cfg)
+    self.proc = None
+    self.dir = None
+    self.dvi = None
+    self.lines = None
+    self.count = 0
+    self.log = None
+    self.lock = threading.Lock()
+    self.follower = None
+    self.followcmd = None
+    self.followfail = False
+    self.timedout = False
+
+  def alive(self):
+    """
+    True if the latex process is running.
+    """
+    return self.proc is not None and self.proc.poll() is None
+
+  def start(self):
+    """
+    Start latex in its own directory and load the document head.
+    Returns True if the worker is ready.
+    """
+    self.stop()
+    self.timedout = False
+    self.dir = scratchDir(self.cfg)
+    self.dvi = DviFile(os.path.join(self.dir, self.cfg.dvifile))
+    self.count = 0
+    env = dict(os.environ)
+    env['dvi_buf_size'] = str(self.cfg.dvibufsize)
+    cmd = self.cfg.workercmd.format(self.cfg.latex)
+    if self.fmt:
+      cmd += self.cfg.fmtopt.format(self.fmt)
+    self.proc = spawn(cmd, stdin = PIPE, stdout = PIPE, stderr = STDOUT,
+      cwd = self.dir, env = env)
+    self.lines = Queue()
+    t = threading.Thread(target = self._reader,
+                         args = (self.proc.stdout, self.lines))
+    t.daemon = True
+    t.start()
+    r = self._send(self.head + self._marker(0), [0])
+    if r and r[0][0]:
+      return True
+    self.log = r[0][1] if r else None
+    return False
+
+  def stop(self):
+    """
+    Kill the latex process (its process group, see spawn) and remove its
+    directory.
+    """
+    if self.proc is not None:
+      _kill(self.proc)
+      try:
+        self.proc.wait()
+      except OSError:
+        pass
+    self.proc = None
+    self.unfollow()
+    if self.dir is not None:
+      shutil.rmtree(self.dir, True)
+      self.dir = None
+
+  def follow(self, cfg):
+    """
+    Start dvipng --follow on the dvi file with the dvipng settings of cfg.
+    Returns False if dvipng failed before or runs with other settings (the
+    worker then restarts with a fresh dvi at the next request).
+    """
+    cmd = cfg.dvipngcmd.format(cfg.dvipng + cfg.followopt, cfg.imagesize,
+      cfg.resolution, cfg.backcolor, cfg.forecolor, cfg.offset,
+      cfg.pngpages, cfg.dvifile)
+    if self.followfail or self.dir is None:
+      return False
+    if self.follower is not None:
+      if self.followcmd == cmd:
+        return True
+      self.count = self.cfg.workermaxpages
+      return False
+    self.followcmd = cmd
+    self.follower = spawn(cmd, stdout = open(os.devnull, 'wb'),
+      stderr = STDOUT, cwd = self.dir)
+    return True
+
+  def unfollow(self):
+    """
+    Kill the dvipng --follow process (its process group, see spawn).
+    """
+    if self.follower is not None:
+      _kill(self.follower)
+      try:
+        self.follower.wait()
+      except OSError:
+        pass
+    self.follower = None
+
+  def png(self, n, cfg):
+    """
+    The PNG image of page n converted by dvipng --follow (see follow), None
+    if it is not available.
+    """
+    if not self.follow(cfg):
+      return None
+    path = os.path.join(self.dir, cfg.pngpages % n)
+    end = time.time() + workerWait(cfg)
+    while time.time() < end:
+      try:
+        f = open(path, 'rb')
+        png = f.read()
+        f.close()
+        if png.endswith(b'IEND\xaeB`\x82'): # complete
+          os.remove(path)
+          return png
+      except (IOError, OSError):
+        pass
+      if self.follower.poll() is not None:
+        self.followfail = True # e.g. no --follow support
+        self.unfollow()
+        return None
+      time.sleep(0.002)
+    self.followfail = True # hangs
+    self.unfollow()
+    return None
+
+  def typeset_many(self, srcs, wait = None):
+    """
+    Typeset each source on a new page, waiting up to wait seconds per
+    page (default workerWait). Returns a list with one entry per source:
+    (dvi, n, log) where dvi is the DviFile holding page n, or None on a
+    TeX error or if the page timed out (see log). The entry is None if
+    the worker crashed or the source comes after a timed out one (the
+    caller should fall back to a latex run).
+    """
+    res = [None] * len(srcs)
+    with self.lock:
+      i = 0
+      while i < len(srcs):
+        if not self.alive() or self.count >= self.cfg.workermaxpages:
+          if not self.start():
+            self.stop()
+            break
+        n = self.count + 1
+        todo = srcs[i:]
+        s = []
+        for k, src in enumerate(todo):
+          s.append(pageSource(n + k, src))
+          if k == len(todo) - 1:
+            # The padding page pushes all pages through TeX's and stdio's
+            # buffers into the dvi file
+            s.append('{\\count0=-%d\\shipout\\hbox{\\special{src:%s}}}'
+                     % (n + k, 'x' * (2 * self.cfg.dvibufsize)))
+          s.append(self._marker(n + k))
+        r = self._send(''.join(s), range(n, n + len(todo)), wait)
+        self.count = n + len(todo) - 1
+        self.dvi.update()
+        # Pages after a TeX error are typeset again by a fresh worker
+        done = 0
+        for ok, log in r:
+          res[i + done] = (self.dvi if ok else None, n + done, log)
+          done += 1
+          if not ok:
+            break
+        error = done > 0 and not r[done - 1][0]
+        i += done
+        if error:
+          self.stop() # the TeX state may be broken
+        elif done < len(todo):
+          print self.cfg.errworker # crash or timeout
+          if self.timedout: # that page fails, no second try
+            res[i] = (None, n + done,
+                      'latex worker: no page within %gs' % wait)
+          self.stop()
+          break
+    return res
+
+  def _marker(self, n):
+    """
+    TeX code which writes the marker line of page n to the terminal.
+    """
+    return '\n\\immediate\\write16{@@sympyprt:%d@@}\n' % n
+
+  def _send(self, s, pages, wait = None):
+    """
+    Send s and wait for the marker lines of pages (up to wait seconds
+    each, default workerWait). Returns a list of (ok, log) per marker, ok
+    is False if a TeX error occurred. The list is shorter if the worker
+    crashed or timed out (timedout).
+    """
+    wait = wait or workerWait(self.cfg)
+    out = []
+    log = []
+    try:
+      self.proc.stdin.write(_bytes(s))
+      self.proc.stdin.flush()
+      for n in pages:
+        marker = '@@sympyprt:%d@@' % n
+        while True:
+          line = self.lines.get(timeout = wait)
+          if line is None:
+            return out
+          line = _text(line)
+          if marker in line:
+            break
+          log.append(line)
+        ok = not any(l.lstrip('*').startswith('!') for l in log)
+        out.append((ok, ''.join(log)))
+        log = []
+    except Empty:
+      self.timedout = True
+    except (IOError, OSError):
+      pass
+    return out
+
+  @staticmethod
+  def _reader(f, q):
+    """
+    Copy the lines of f (latex stdout) to the queue q, None at EOF.
+    """
+    for line in iter(f.readline, b''):
+      q.put(line)
+    q.put(None)
+
+
+# Idle workers per document head and format, all started workers
+_workers = {}
+_workers_all = []
+_workers_lock = threading.Lock()
+
+def getWorker(head, fmt = None, cfg = gcfg):
+  """
+  Check out an idle TeXWorker for the document head (a new one if all are
+  busy). Give it back with putWorker.
+  """
+  with _workers_lock:
+    idle = _workers.setdefault((head, fmt), [])
+    if idle:
+      return idle.pop()
+    w = TeXWorker(head, fmt, cfg)
+    _workers_all.append(w)
+    return w
+
+def putWorker(w):
+  """
+  Return a worker checked out by getWorker.
+  """
+  with _workers_lock:
+    if w in _workers_all:
+      _workers[w.head, w.fmt].append(w)
+      return
+  w.stop() # stopped by stopWorkers meanwhile
+
+def stopWorkers():
+  """
+  Stop all latex workers.
+  """
+  with _workers_lock:
+    for w in _workers_all:
+      w.stop()
+    del _workers_all[:]
+    _workers.clear()
+
+atexit.register(stopWorkers)
+
+def workerWait(cfg = gcfg):
+  """
+  Seconds a worker waits for a page: fs.workertimeout, at most
+  fs.rendertimeout (a timed out page fails like a one-shot run would).
+  """
+  if cfg.rendertimeout:
+    return min(cfg.workertimeout, cfg.rendertimeout)
+  return cfg.workertimeout
+
+def workerFor(fmt = None, cfg = gcfg):
+  """
+  Check out a TeXWorker for the preamble of cfg (fmt: its format file).
+  """
+  mark = '\x00'
+  head = (cfg.preamble % (cfg.fontsize, mark)).split(mark)[0]
+  if fmt:
+    head = head[head.find(_BEGIN):]
+  return getWorker(head, fmt, cfg)
+
+def scratchDir(cfg = gcfg):
+  """
+  Create a private working directory for one render (see fs.scratchdir).
+  """
+  return tempfile.mkdtemp(prefix = 'sympyprt-', dir = cfg.scratchdir)
+
+def spawn(cmd, **kw):
+  """
+  Popen(cmd, shell = True, **kw) in a new process group (POSIX). The
+  shell (e.g. dash) may fork the command instead of exec'ing it, so
+  _kill kills the whole group.
+  """
+  if os.name == 'posix':
+    kw['preexec_fn'] = os.setsid
+  return Popen(cmd, shell = True, **kw)
+
+def communicate(p, data = None, timeout = None):
+  """
+  p.communicate(data), but kill p (started by spawn: with the command
+  run by its shell) after timeout seconds (None or 0: wait forever). A
+  killed process has a negative returncode.
+  """
+  timer = None
+  if timeout:
+    timer = threading.Timer(timeout, _kill, (p,))
+    timer.daemon = True
+    timer.start()
+  try:
+    return p.communicate(data)
+  finally:
+    if timer is not None:
+      timer.cancel()
+      timer.join() # no timer thread left at exit (py2 prints an error)
+
+def _kill(p):
+  """
+  Kill the process group of p (see spawn), only p elsewhere.
+  """
+  try:
+    if os.name == 'posix':
+      os.killpg(p.pid, signal.SIGKILL)
+    else:
+      p.kill()
+  except OSError:
+    pass
+
+def runLaTeX(src, fmt = None, cfg = gcfg, cwd = None, timeout = None):
+  """
+  Run latex once on the document of src, the output is cfg.dvifile in
+  the directory cwd. With the format file fmt only the document body is
+  sent. Returns the output of latex and the return code. The run is
+  killed after timeout seconds (default fs.rendertimeout).
+  """
+  latex = cfg.latexcmd.format(cfg.latex)
+  if timeout is None:
+    timeout = cfg.rendertimeout
+  if fmt:
+    p = spawn(latex + cfg.fmtopt.format(fmt),
+              stdin = PIPE, stdout = PIPE, cwd = cwd)
+    log = communicate(p, _bytes(splitDocument(cfg, src)[1]), timeout)
+
+    # A stale format (e.g. TeX was updated) => drop it, no preamble
+    if p.returncode == 0 or not _FMTERR.search(_text(log[0] or '')):
+      return log, p.returncode
+    dropFormat(fmt)
+
+  # Note: going to write to latex's stdin => needs to be piped
+  p = spawn(latex, stdin = PIPE, stdout = PIPE, cwd = cwd)
+
+  # Send input & read stdout/stderr
+  log = communicate(p, _bytes(cfg.preamble % (cfg.fontsize, src)), timeout)
+  return log, p.returncode
+
+
+#;;;;;;;;;;;;;;;
+# Class TeX2 ;;;
+#;;;;;;;;;;;;;;;
+class TeX2():
+  """
+  Convert TeX code to a PNG image via dvi using the 'dvipng' command.
+  Credit: dvipng 1.XX Copyright 2002-2008 Jan-Ake Larsson
+  Details: http://www.nongnu.org/dvipng/dvipng_4.html
+  -- This is by far the shortest and fastest version (compared to older TeX2).
+  """
+
+  def __init__(self, src, cfg = gcfg):
+    """
+    The parameter src should be TeX code without preamble and without begin/end
+    document commands. The optional parameter cfg can be a modified instance
+    of the factory settings class fs.
+    """
+
+    # Frozen snapshot of cfg (later changes to cfg don't affect it)
+    self.cfg = snapshot(cfg)
+    self.src = src
+
+    # Log (subprocess/communicate output in case of errors)
+    self.log = None
+
+    # The PNG file
+    self.pngfile = None
+
+    # The scratch directory (while rendering)
+    self.dir = None
+
+    # The PNG image (string/x89PNG)
+    self.png = None
+
+    # The coverage mask of the image (see recolor)
+    self.mask = None
+
+    # Render now or later?
+    if cfg.initrender:
+      self.render(self.cfg)
+
+
+  def render(self, cfg):
+    """
+    Run latex then convert the dvi output to png. The mandatory cfg
+    has to be an instance of fs (usually self.cfg).
+    """
+    t0 = time.time()
+
+    # Document and command lines
+    self.commands(cfg)
+
+    # Rendered before in other colors => colorize the mask
+    if self.recolor(cfg):
+      Stats.add('TeX2', 'recolor', time.time() - t0, len(self.png))
+      return
+
+    # On-disk cache (rendered before, maybe by another kernel)
+    disk = diskCache(cfg)
+    if disk is not None:
+      self.png = disk.get(renderKey(self.src, cfg))
+      if self.png is not None:
+        Stats.add('TeX2', 'disk', time.time() - t0, len(self.png))
+        self.keepmask(cfg)
+        return
+
+    # Private working directory
+    self.cleanup()
+    self.dir = scratchDir(cfg)
+    self.png = None
+
+    # Latex (or the dvi cache) then dvipng (unless dvipng --follow did it)
+    if not self.makedvi(cfg, cfg.follow):
+      return
+    if self.png is None and not self.convert(cfg):
+      return
+
+    if disk is not None:
+      disk.put(renderKey(self.src, cfg), self.png)
+    self.keepmask(cfg)
+
+    # Remove all output files
+    t = time.time()
+    self.cleanup()
+    Stats.add('TeX2', 'cleanup', time.time() - t)
+    Stats.add('TeX2', 'total', time.time() - t0, len(self.png))
+
+
+  def recolor(self, cfg):
+    """
+    Set the png property from the coverage mask of an earlier render in
+    other colors (MaskCache), i.e. without latex and dvipng. Returns False
+    if there is no mask (or recolor is off).
+    """
+    if not cfg.recolor:
+      return False
+    colors = texColors(cfg)
+    mask = MaskCache.get(maskKey(self.src, cfg)) if colors else None
+    if mask is None:
+      return False
+    self.mask = mask
+    self.png = colorize(mask, *colors)
+    return True
+
+
+  def keepmask(self, cfg):
+    """
+    Extract the coverage mask of the png property and keep it in
+    MaskCache (for recolor).
+    """
+    if not cfg.recolor or self.png is None or self.mask is not None:
+      return
+    colors = texColors(cfg)
+    if colors is not None:
+      self.mask = pngMask(self.png, *colors)
+    if self.mask is not None:
+      MaskCache[maskKey(self.src, cfg)] = self.mask
+
+
+  def makedvi(self, cfg, follow = False):
+    """
+    Write the dvi file of src into the scratch directory: from DviCache,
+    by the worker (follow: also get the png from dvipng --follow) or a
+    latex run. Returns False on errors.
+    """
+    dvifile = os.path.join(self.dir, cfg.dvifile)
+    name = self.__class__.__name__
+
+    # The dvi of an earlier render (only dvipng settings changed)
+    dvi = DviCache.get(dviKey(self.src, cfg)) if cfg.dvicache else None
+    if dvi is not None:
+      Stats.count(name, 'dvihit')
+      f = open(dvifile, 'wb')
+      f.write(dvi)
+      f.close()
+      return True
+
+    # Precompiled preamble (format file) if available
+    fmt = formatFile(cfg)
+
+    # Typeset with the persistent latex worker if possible
+    rc = self.typeset(cfg, fmt, follow) if cfg.worker else None
+
+    if rc is False:
+      print cfg.errlatex
+      self.cleanup()
+      return False
+
+    if rc is None:
+      # Run latex once (writes cfg.dvifile)
+      t = time.time()
+      log, rc = runLaTeX(self.src, fmt, cfg, self.dir)
+      Stats.add(name, 'latex', time.time() - t)
+
+      # Check for errors (<>0)
+      if  rc != 0:
+        print cfg.errlatex
+        self.log = log
+        self.cleanup()
+        return False
+
+    if cfg.dvicache:
+      try:
+        f = open(dvifile, 'rb')
+        DviCache[dviKey(self.src, cfg)] = f.read()
+        f.close()
+      except IOError:
+        pass
+    return True
+
+
+  def convert(self, cfg):
+    """
+    Run the dvi to png conversion. Returns False on dvipng errors or if
+    dvipng wrote no page.
+    """
+    t = time.time()
+    p = spawn(self.dvipng, stdout = PIPE, cwd = self.dir)
+
+    # Read stdout/stderr
+    log = communicate(p, None, cfg.rendertimeout)
+    Stats.add('TeX2', 'dvipng', time.time() - t)
+
+    # Check for errors (<>0)
     if p.returncode != 0:
       print cfg.errdvipng
       self.log = log
       self.cleanup()
-      return
+      return False
 
     # Set the png image path
-    self.pngfile = cfg.pngfile
+    self.pngfile = os.path.join(self.dir, cfg.pngfile)
 
     # Read and store the PNG image (use binary read)
-    f = open(self.pngfile, 'rb')
-    self.png = f.read()
+    t = time.time()
+    try:
+      f = open(self.pngfile, 'rb')
+      self.png = f.read()
+      f.close()
+    except IOError: # no page
+      print cfg.errdvipng
+      self.log = log
+      self.cleanup()
+      return False
+    Stats.add('TeX2', 'read', time.time() - t)
+    return True
+
+
+  def commands(self, cfg):
+    """
+    Set the document (preamble property) and the latex/dvipng commands.
+    """
+    # Default template
+    self.preamble = cfg.preamble % (cfg.fontsize, self.src)
+
+    # LaTeX command
+    self.latex = cfg.latexcmd.format(cfg.latex)
+
+    # Dvipng command
+    self.dvipng = cfg.dvipngcmd.format(cfg.dvipng, cfg.imagesize,
+      cfg.resolution, cfg.backcolor, cfg.forecolor, cfg.offset,
+      cfg.pngfile, cfg.dvifile)
+
+
+  def typeset(self, cfg, fmt = None, follow = False):
+    """
+    Typeset the source with the persistent latex worker (see TeXWorker)
+    and write the page to cfg.dvifile (scratch directory). With follow the
+    png property is set if dvipng --follow converted the page. Returns
+    True on success, False on a TeX error and None if the worker is not
+    usable (run latex instead).
+    """
+    name = self.__class__.__name__
+    w = workerFor(fmt, cfg)
+    try:
+      t = time.time()
+      r = w.typeset_many([self.src], workerWait(cfg))[0]
+      if r is None:
+        return None
+      Stats.add(name, 'latex', time.time() - t)
+      if r[0] is None:
+        self.log = r[2]
+        return False
+      dvi = r[0].page(r[1])
+      if dvi is not None and follow:
+        t = time.time()
+        self.png = w.png(r[1], cfg)
+        Stats.add(name, 'dvipng', time.time() - t)
+    finally:
+      putWorker(w)
+    if dvi is None:
+      return None
+    f = open(os.path.join(self.dir, cfg.dvifile), 'wb')
+    f.write(dvi)
     f.close()
+    return True
 
-    # Remove all output files
-    self.cleanup()
+
+  @staticmethod
+  def render_many(srcs, cfg = gcfg):
+    """
+    Render a list of TeX sources at once: the formulas are typeset as the
+    pages of one dvi (by the worker or a single latex run) and converted
+    by one dvipng call. Returns the TeX2 instances in the same order.
+    Formulas which fail in the batch are rendered one by one.
+    """
+    t0 = time.time()
+    c = snapshot(cfg, initrender = False)
+    cfg = snapshot(cfg)
+    objs = [TeX2(s, c) for s in srcs]
+    for x in objs:
+      x.cfg = cfg
+      x.commands(x.cfg)
+
+    # Rendered before in other colors, on-disk cache
+    disk = diskCache(cfg)
+    todo = [x for x in objs if not x.recolor(cfg)]
+    if disk is not None:
+      for x in todo:
+        x.png = disk.get(renderKey(x.src, cfg))
+      todo = [x for x in todo if x.png is None]
+
+    # Pages to convert: [(DviFile, [(obj, count0), ...]), ...]
+    docs = []
+
+    # Cached dvi files are joined into as few documents as the fonts allow
+    if cfg.dvicache and todo:
+      cached, rest = [], []
+      for x in todo:
+        dvi = DviCache.get(dviKey(x.src, cfg))
+        if dvi is None:
+          rest.append(x)
+          continue
+        n = len(cached) + 1
+        for doc, pages in docs:
+          if doc.add(dvi, n):
+            pages.append((x, n))
+            break
+        else:
+          doc = DviFile(None)
+          if doc.add(dvi, n):
+            docs.append((doc, [(x, n)]))
+          else:
+            rest.append(x)
+            continue
+        cached.append(x)
+      todo = rest
+    fmt = formatFile(cfg) if todo else None
+
+    # The worker stays checked out until its pages are converted
+    w = workerFor(fmt, cfg) if cfg.worker and todo else None
+    singles = []
+    tmp = scratchDir(cfg)
+    try:
+      if w is not None:
+        groups = {}
+        batch, todo = todo, []
+        t = time.time()
+        res = w.typeset_many([x.src for x in batch], workerWait(cfg))
+        Stats.add('batch', 'latex', time.time() - t)
+        for x, r in zip(batch, res):
+          if r is None:
+            todo.append(x)
+          elif r[0] is None:
+            print cfg.errlatex
+            x.log = r[2]
+          else:
+            # Converted by dvipng --follow or to be converted below
+            x.png = w.png(r[1], cfg) if cfg.follow else None
+            if x.png is None:
+              groups.setdefault(r[0], []).append((x, r[1]))
+              continue
+            dvi = r[0].page(r[1])
+            if cfg.dvicache and dvi is not None:
+              DviCache[dviKey(x.src, cfg)] = dvi
+            if disk is not None:
+              disk.put(renderKey(x.src, cfg), x.png)
+        docs.extend(groups.items())
+
+      # One latex run for the rest (no worker, worker crashed)
+      if todo:
+        body = '\n'.join(pageSource(n, x.src) for n, x in enumerate(todo, 1))
+        t = time.time()
+        log, rc = runLaTeX(body, fmt, cfg, tmp,
+                           cfg.rendertimeout and cfg.rendertimeout * len(todo))
+        Stats.add('batch', 'latex', time.time() - t)
+        if rc == 0:
+          dvi = DviFile(os.path.join(tmp, cfg.dvifile))
+          dvi.update()
+          docs.append((dvi, [(x, n) for n, x in enumerate(todo, 1)]))
+        else:
+          singles.extend(todo)
+
+      # One dvipng call per dvi
+      for dvi, pages in docs:
+        singles.extend(x for x, n in pages if n not in dvi.pages)
+        pages = [(x, n) for x, n in pages if n in dvi.pages]
+        if not pages:
+          continue
+        if cfg.dvicache:
+          for x, n in pages:
+            key = dviKey(x.src, cfg)
+            if key not in DviCache:
+              DviCache[key] = dvi.document([n], True)
+        f = open(os.path.join(tmp, cfg.dvifile), 'wb')
+        f.write(dvi.document([n for x, n in pages]))
+        f.close()
+        p = spawn(cfg.dvipngcmd.format(cfg.dvipng, cfg.imagesize,
+          cfg.resolution, cfg.backcolor, cfg.forecolor, cfg.offset,
+          cfg.pngpages, cfg.dvifile), stdout = PIPE, cwd = tmp)
+        t = time.time()
+        communicate(p, None, cfg.rendertimeout and
+                    cfg.rendertimeout * len(pages))
+        Stats.add('batch', 'dvipng', time.time() - t)
+        for k, (x, n) in enumerate(pages, 1):
+          try:
+            f = open(os.path.join(tmp, cfg.pngpages % k), 'rb')
+            x.png = f.read()
+            f.close()
+            os.remove(os.path.join(tmp, cfg.pngpages % k))
+          except (IOError, OSError):
+            singles.append(x)
+            continue
+          if disk is not None:
+            disk.put(renderKey(x.src, cfg), x.png)
+    finally:
+      if w is not None:
+        putWorker(w)
+      shutil.rmtree(tmp, True)
+
+    for x in singles:
+      x.render(x.cfg)
+    for x in objs:
+      x.keepmask(cfg)
+    Stats.add('batch', 'total', time.time() - t0,
+              sum(len(x.png or b'') for x in objs))
+    return objs
 
 
   def cleanup(self):
     """
-    Remove all fs.jobname{fs.exts} files and reset pngfile to None.
+    Remove the scratch directory (all fs.jobname{fs.exts} files) and reset
+    pngfile to None.
     """
-    try:
-      for f in map(lambda x: self.cfg.jobname + '.' + x, self.cfg.exts):
-        os.remove(f)
-    except:
-      pass
+    if self.dir is not None:
+      shutil.rmtree(self.dir, True)
+      self.dir = None
     self.pngfile = None
 
 
@@ -532,8 +2646,8 @@ class TeX2():
     hand you can do this manually by x.render(x.cfg), where x is the
     instance name (e.g. if you want to change several parameters).
     """
-    self.cfg.forecolor = forecolor
-    self.cfg.backcolor = backcolor
+    self.cfg = snapshot(self.cfg, forecolor = forecolor,
+                        backcolor = backcolor)
     if redraw: self.render(self.cfg)
 
 
@@ -546,8 +2660,7 @@ class TeX2():
     hand you can do this manually by x.render(x.cfg), where x is the
     instance name (e.g. if you want to change several parameters).
     """
-    self.cfg.fontsize = pt
-    self.cfg.resolution = dpi
+    self.cfg = snapshot(self.cfg, fontsize = pt, resolution = dpi)
     if redraw: self.render(self.cfg)
 
 
@@ -558,7 +2671,7 @@ class TeX2():
     hand you can do this manually by x.render(x.cfg), where x is the
     instance name (e.g. if you want to change several parameters).
     """
-    self.cfg.imagesize = imagesize
+    self.cfg = snapshot(self.cfg, imagesize = imagesize)
     if redraw: self.render(self.cfg)
 
 
@@ -569,10 +2682,418 @@ class TeX2():
     return self.png
 
 
+#;;;;;;;;;;;;;;;
+# Class TeX3 ;;;
+#;;;;;;;;;;;;;;;
+class TeX3(TeX2):
+  """
+  Convert TeX code to an SVG image via dvi using the 'dvisvgm' command.
+  The glyphs are paths (each glyph is defined once and referenced), so the
+  image is small and scales to any zoom level. The latex part (worker,
+  format files, dvi cache) is the same as for TeX2.
+  """
+
+  def __init__(self, src, cfg = gcfg):
+    """
+    See TeX2. The image is stored in the svg property (text).
+    """
+    self.svg = None
+    TeX2.__init__(self, src, cfg)
+
+
+  def render(self, cfg):
+    """
+    Run latex then convert the dvi output to svg. The mandatory cfg
+    has to be an instance of fs (usually self.cfg).
+    """
+    t0 = time.time()
+
+    # Document and command lines
+    self.commands(cfg)
+
+    # On-disk cache
+    disk = diskCache(cfg)
+    if disk is not None:
+      self.svg = disk.get(svgKey(self.src, cfg), '.svg')
+      if self.svg is not None:
+        Stats.add('TeX3', 'disk', time.time() - t0, len(self.svg))
+        return
+
+    # Private working directory
+    self.cleanup()
+    self.dir = scratchDir(cfg)
+    self.svg = None
+
+    if not self.makedvi(cfg) or not self.convert(cfg):
+      return
+
+    if disk is not None:
+      disk.put(svgKey(self.src, cfg), self.svg, '.svg')
+
+    # Remove all output files
+    t = time.time()
+    self.cleanup()
+    Stats.add('TeX3', 'cleanup', time.time() - t)
+    Stats.add('TeX3', 'total', time.time() - t0, len(self.svg))
+
+
+  def convert(self, cfg):
+    """
+    Run the dvi to svg conversion. Returns False on dvisvgm errors.
+    """
+    t = time.time()
+    p = spawn(cfg.dvisvgmcmd.format(cfg.dvisvgm, cfg.dvifile),
+              stdout = PIPE, stderr = PIPE, cwd = self.dir)
+    log = communicate(p, None, cfg.rendertimeout)
+    Stats.add('TeX3', 'dvisvgm', time.time() - t)
+    if p.returncode != 0 or not log[0]:
+      print cfg.errdvisvgm
+      self.log = log
+      self.cleanup()
+      return False
+    self.svg = svgStyle(_text(log[0]), cfg)
+    return True
+
+
+  def save_svg(self, filename):
+    """
+    Save the SVG image to filename.
+    """
+    try:
+      f = open(filename, 'wb')
+      f.write(_bytes(self.svg))
+      f.close()
+      return True
+    except:
+      return False
+
+
+  def _repr_png_(self):
+    return None
+
+
+  def _repr_svg_(self):
+    """
+    Representation as svg image (returns the svg text).
+    """
+    return self.svg
+
+
+def svgColor(c):
+  """
+  The CSS color of the dvipng color c (e.g. Blue, rgb 1 0 0, gray 0.5,
+  cmyk 0 1 1 0 or Transparent).
+  """
+  if c.lower() == 'transparent':
+    return 'none'
+  rgb = texColor(c)
+  if rgb is None:
+    return c.lower()
+  return 'rgb(%d,%d,%d)' % tuple(int(round(255 * x)) for x in rgb)
+
+def svgStyle(svg, cfg = gcfg):
+  """
+  Apply fs.forecolor and fs.backcolor to the svg text (dvisvgm output).
+  """
+  style = ' fill="%s"' % svgColor(cfg.forecolor)
+  if svgColor(cfg.backcolor) != 'none':
+    style += ' style="background-color:%s"' % svgColor(cfg.backcolor)
+  return svg.replace('<svg ', '<svg' + style + ' ', 1)
+
+
+#;;;;;;;;;;;;;;;;;;;;
+# Cache entries ;;;
+#;;;;;;;;;;;;;;;;;;;;
+class CacheEntry(object):
+  """
+  An image in ObjCache: the PNG (or SVG) image, the TeX source and a
+  shared config snapshot (see snapshot), but not the document, the
+  command lines and the log of the TeX2/TeX3 instance which rendered it.
+  """
+  __slots__ = ('src', 'cfg', 'png', 'svg')
+
+  def __init__(self, src, cfg, png = None, svg = None):
+    self.src = src
+    self.cfg = cfg
+    self.png = png
+    self.svg = svg
+
+  @staticmethod
+  def of(x):
+    """
+    The entry of the rendered TeX2/TeX3 instance x.
+    """
+    return CacheEntry(x.src, snapshot(x.cfg), x.png, getattr(x, 'svg', None))
+
+  @property
+  def preamble(self):
+    """
+    The LaTeX document (built on demand, see TeX2.preamble).
+    """
+    return self.cfg.preamble % (self.cfg.fontsize, self.src)
+
+  def render(self, cfg = None):
+    """
+    Render the source again with cfg (default: the snapshot) and keep the
+    new image. Returns the TeX2/TeX3 instance (see its log on errors).
+    """
+    cfg = self.cfg if cfg is None else cfg
+    x = (TeX3 if self.svg is not None else TeX2)(self.src, cfg)
+    if not cfg.initrender:
+      x.render(x.cfg)
+    if x.png is not None or getattr(x, 'svg', None) is not None:
+      self.png, self.svg = x.png, getattr(x, 'svg', None)
+      self.cfg = snapshot(x.cfg)
+    return x
+
+  def _repr_png_(self):
+    return self.png
+
+  def _repr_svg_(self):
+    return self.svg
+
+
+#;;;;;;;;;;;;;;;;
+# Render pool ;;;
+#;;;;;;;;;;;;;;;;
+class RenderJob():
+  """
+  One chunk of work for the RenderPool: fn(values, *args) returns the
+  objects for keys (same order).
+  """
+
+  def __init__(self, keys, fn, args):
+    self.keys = keys
+    self.fn = fn
+    self.args = args
+    self.objs = {}
+    self.error = None
+    self.done = threading.Event()
+    self.callbacks = []
+    self.lock = threading.Lock()
+
+  def run(self):
+    try:
+      self.objs = dict(zip(self.keys, self.fn(*self.args)))
+    except Exception as e:
+      self.error = e
+    finally:
+      with self.lock:
+        self.done.set()
+      for f in self.callbacks:
+        f(self)
+
+  def then(self, f):
+    """
+    Call f(job) when the job is done (now if it is done already).
+    """
+    with self.lock:
+      if not self.done.is_set():
+        self.callbacks.append(f)
+        return
+    f(self)
+
+
+class RenderPool():
+  """
+  Threads running RenderJobs. A key which is being rendered is not
+  submitted again, the caller waits for the running job instead. With
+  n = 0 the jobs run in the calling thread.
+  """
+
+  def __init__(self, n = 0):
+    self.n = 0
+    self.jobs = Queue()
+    self.running = {} # key -> RenderJob
+    self.lock = threading.Lock()
+    self.resize(n)
+
+  def resize(self, n):
+    """
+    Set the number of threads.
+    """
+    with self.lock:
+      while self.n < n:
+        t = threading.Thread(target = self._work)
+        t.daemon = True
+        t.start()
+        self.n += 1
+      while self.n > max(n, 0):
+        self.jobs.put(None)
+        self.n -= 1
+
+  def run(self, items, fn, *args):
+    """
+    Call fn(values, *args) for the [(key, value), ...] items in chunks
+    (one per thread) and wait. Returns a dict key -> object (without the
+    keys of failed chunks).
+    """
+    out = {}
+    for job in self.submit(items, fn, *args):
+      job.done.wait()
+      out.update(job.objs)
+    return dict((key, out[key]) for key, v in items if key in out)
+
+  def submit(self, items, fn, *args):
+    """
+    Like run but without waiting: returns the RenderJobs of the items.
+    """
+    jobs, new, todo = [], [], []
+    with self.lock:
+      for key, v in items:
+        job = self.running.get(key)
+        if job is None:
+          if key not in (k for k, v in todo):
+            todo.append((key, v))
+        elif job not in jobs:
+          jobs.append(job)
+      k = max(1, min(self.n, len(todo)))
+      for i in range(k):
+        chunk = todo[i::k]
+        if chunk:
+          job = RenderJob([c[0] for c in chunk],
+                          fn, ([c[1] for c in chunk],) + args)
+          for key in job.keys:
+            self.running[key] = job
+          new.append(job)
+      n = self.n
+    for job in new:
+      if n:
+        self.jobs.put(job)
+      else:
+        self._run(job)
+    return jobs + new
+
+  def _run(self, job):
+    job.run()
+    with self.lock:
+      for key in job.keys:
+        if self.running.get(key) is job:
+          del self.running[key]
+
+  def _work(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      self._run(job)
+
+
+def renderChunk(srcs, cfg):
+  """
+  Render TeX sources (RenderPool function): TeX2 or TeX2.render_many.
+  """
+  if len(srcs) == 1:
+    return [TeX2(srcs[0], cfg)]
+  return TeX2.render_many(srcs, cfg)
+
+def svgChunk(srcs, cfg):
+  """
+  Render TeX sources as SVG (RenderPool function).
+  """
+  return [TeX3(s, cfg) for s in srcs]
+
+Renderer = RenderPool(gcfg.workers)
+
+def staleKeys(cfg = gcfg):
+  """
+  The keys of the ObjCache entries rendered with other pixel settings
+  than cfg (e.g. after %sympyprt fontsize 12), which it can't hit any
+  more. Each distinct snapshot is compared once.
+  """
+  px = pixels(cfg)
+  stale = {}
+  return [k for k, x in ObjCache.items() if isinstance(x, CacheEntry)
+          and stale.setdefault(x.cfg, pixels(x.cfg) != px)]
+
+def redrawCache(fresh = False):
+  """
+  Render the formulas of all cached images again with the current
+  settings (in fs.workers parallel batches, see TeX2.render_many) and
+  replace the entries of other settings, e.g. after a global color or
+  fontsize change. fresh (after a TeX or format update): latex runs again
+  (new workers, no dvi files, masks or disk cache hits). The formulas
+  which failed are tried again when displayed.
+  """
+  FailCache.clear()
+  cfg = snapshot(gcfg)
+  disk = None
+  if fresh:
+    stopWorkers()
+    DviCache.clear()
+    MaskCache.clear()
+    disk = diskCache(gcfg)
+    cfg = snapshot(gcfg, diskcache = False)
+  for ext, chunk, keyf in (('.png', renderChunk, renderKey),
+                           ('.svg', svgChunk, svgKey)):
+    entries = [(k, x) for k, x in ObjCache.items()
+               if isinstance(x, CacheEntry) and
+               (x.svg is None) == (ext == '.png')]
+    srcs = dict((keyf(x.src, cfg), x.src) for k, x in entries)
+    objs = Renderer.run(list(srcs.items()), chunk, cfg)
+    moved = {}
+    for k, x in entries:
+      if keyf(x.src, cfg) != k:
+        moved[k] = keyf(x.src, cfg)
+        if k in ObjCache:
+          del ObjCache[k]
+    for k, repr_obj in objs.items():
+      putRender(k, repr_obj)
+      x = ObjCache.peek(k)
+      if disk is not None and x is not None:
+        disk.put(k, x.png or x.svg, ext)
+    Tracker.rekey(ObjCache, moved)
+
+
 #;;;;;;;;;;;;;;;;;;;;;;;
 # Printing functions ;;;
 #;;;;;;;;;;;;;;;;;;;;;;;
 
+def logText(log):
+  """
+  The log of a failed render as text (log is None, a string or the
+  (stdout, stderr) tuple of communicate).
+  """
+  if isinstance(log, tuple):
+    return '\n'.join(_text(x) for x in log if x)
+  return _text(log) if log else ''
+
+
+def putRender(key, repr_obj):
+  """
+  Store a rendered TeX2/TeX3 instance: as CacheEntry in ObjCache or,
+  without an image, its log in FailCache.
+  """
+  if repr_obj.png is None and getattr(repr_obj, 'svg', None) is None:
+    Stats.count(repr_obj.__class__.__name__, 'error')
+    FailCache[key] = logText(repr_obj.log)
+  else:
+    ObjCache[key] = CacheEntry.of(repr_obj)
+
+
+def failLog(obj, cfg = gcfg):
+  """
+  The log of the failed render of the sympy object obj (None if it did
+  not fail with the current settings).
+  """
+  s = texSource(obj, cfg)
+  return FailCache.get(svgKey(s, cfg) if cfg._use == 'svg' else
+                       renderKey(s, cfg))
+
+
+def fallback(obj, cfg = gcfg):
+  """
+  The image of a formula latex failed on (fs.fallback): mathtext or None
+  (IPython shows the text).
+  """
+  if cfg.fallback != 'mplib':
+    return None
+  try:
+    return print_png1(obj)
+  except:
+    return None
+
+
 def print_basic_unicode(o, p, cycle):
   """
   A function to pretty print sympy Basic objects.
@@ -590,10 +3111,12 @@ def print_png0(obj):
   Display sympy expression using TeX0.
   """
   if not gcfg._active: return None
-  s = latex(obj, mode = 'inline')
-  s = s.replace('\\operatorname','')
-  s = s.replace('\\overline', '\\bar')
-  png = TeX0(s).png
+  s = inlineSource(obj)
+  key = contentKey('simple', s)
+  png = MathCache.get(key)
+  if png is None:
+    png = TeX0(s).png
+    MathCache[key] = png
   return png
 
 
@@ -602,10 +3125,7 @@ def print_png1(obj):
   Display sympy expression using TeX1.
   """
   if not gcfg._active: return None
-  s = latex(obj, mode = 'inline')
-  s = s.replace('\\operatorname','')
-  s = s.replace('\\overline', '\\bar')
-  png = TeX1(s).png
+  png = TeX1(inlineSource(obj)).png
   return png
 
 
@@ -614,25 +3134,391 @@ def print_png2(self):
   Display sympy expression using TeX2.
   """
   if not gcfg._active: return None
-  if hasObj(self):
-    return getPNG(self) #cached img
+  try:
+    s = texSource(self)
+    key = renderKey(s)
+    Tracker.track(self, ObjCache, key)
+    repr_obj = ObjCache.get(key)
+    if repr_obj is not None:
+      Stats.count('TeX2', 'hit')
+      return repr_obj.png #cached img
+    if key in FailCache:
+      Stats.count('TeX2', 'failhit')
+      return fallback(self)
+    cost = renderCost(self, s)
+    if gcfg.budget and cost > gcfg.budget:
+      Stats.count('TeX2', 'overbudget')
+      return overBudget(self, key, s, cost)
+    Stats.count('TeX2', 'miss')
+    repr_obj = Renderer.run([(key, s)], renderChunk, snapshot(gcfg))[key]
+    putRender(key, repr_obj)
+    return repr_obj.png or fallback(self)
+  except:
+    return None
+
+
+def print_svg(obj):
+  """
+  Display sympy expression using TeX3 (method svg).
+  """
+  if not gcfg._active or gcfg._use != 'svg': return None
+  try:
+    s = texSource(obj)
+    key = svgKey(s)
+    Tracker.track(obj, ObjCache, key)
+    repr_obj = ObjCache.get(key)
+    if repr_obj is not None:
+      Stats.count('TeX3', 'hit')
+      return repr_obj.svg #cached img
+    if key in FailCache:
+      Stats.count('TeX3', 'failhit')
+      return None
+    Stats.count('TeX3', 'miss')
+    repr_obj = Renderer.run([(key, s)], svgChunk, snapshot(gcfg))[key]
+    putRender(key, repr_obj)
+    return repr_obj.svg
+  except:
+    return None
+
+
+#;;;;;;;;;;;;;;;;;;;;;;
+# Object tracking ;;;
+#;;;;;;;;;;;;;;;;;;;;;;
+class LatexEntry(object):
+  """
+  The LaTeX code of a sympy object in LatexCache and a weak reference to
+  the object or, if it can't be weakly referenced (most sympy objects:
+  __slots__), the object itself. The Tracker drops such an entry when the
+  object has left the display history (see purgeCache), so the cache
+  doesn't keep it alive longer. Both match equal objects.
+  """
+  __slots__ = ('src', 'ref')
+
+  def __init__(self, src, obj):
+    self.src = src
+    try:
+      self.ref = weakref.ref(obj)
+    except TypeError:
+      self.ref = obj
+
+  def obj(self):
+    """
+    The object of the entry (None if it was collected).
+    """
+    return self.ref() if isinstance(self.ref, weakref.ref) else self.ref
+
+  def matches(self, obj):
+    """
+    True if obj is the object of the entry or an equal one.
+    """
+    o = self.obj()
+    return o is obj or (o is not None and type(o) is type(obj) and o == obj)
+
+  def orphan(self, i):
+    """
+    True if the object of the entry was collected (i: id of an object
+    which is known to be gone).
+    """
+    if not isinstance(self.ref, weakref.ref):
+      return id(self.ref) == i
+    return self.ref() is None
+
+
+def reachable(roots, ids):
+  """
+  The ids of ids which are reachable from the roots (e.g. IPython's Out
+  and _) through dicts, lists, tuples and sets.
+  """
+  found, seen, todo = set(), set(), list(roots)
+  while todo and len(found) < len(ids):
+    x = todo.pop()
+    if id(x) in seen:
+      continue
+    seen.add(id(x))
+    if id(x) in ids:
+      found.add(id(x))
+    if isinstance(x, dict):
+      todo.extend(x.keys())
+      todo.extend(x.values())
+    elif isinstance(x, (list, tuple, set, frozenset)):
+      todo.extend(x)
+  return found
+
+
+class ObjTracker():
+  """
+  The displayed sympy objects and the cache keys they use (LaTeX code in
+  LatexCache, images in ObjCache). purge() drops the LatexCache entries
+  of the collected objects and the images which no living object uses
+  any more. Objects are watched by weak reference or, if they can't be
+  weakly referenced, by id(): those count as collected when they can't
+  be reached from the roots given to purge (the display history).
+  """
+
+  def __init__(self):
+    self.refs = {}  # id(obj) -> (weakref or None, set of (cache, key))
+    self.users = {} # (cache, key) -> number of living objects using it
+    self.dead = []  # (id, weakref) of collected objects, see purge
+    self.lock = threading.Lock()
+
+  def track(self, obj, cache, key):
+    """
+    Record that obj uses the entry key of cache.
+    """
+    i = id(obj)
+    with self.lock:
+      r = self.refs.get(i)
+      if r is not None and r[0] is not None and r[0]() is None:
+        self._forget(i, gcfg.purge) # id reused before purge
+        r = None
+      if r is None:
+        try:
+          ref = weakref.ref(obj, lambda ref, i = i: self.dead.append((i, ref)))
+        except TypeError:
+          ref = None
+        r = self.refs[i] = (ref, set())
+      if (cache, key) not in r[1]:
+        r[1].add((cache, key))
+        self.users[cache, key] = self.users.get((cache, key), 0) + 1
+
+  def rekey(self, cache, keys):
+    """
+    Let the users of the entries of cache use the new ones for the
+    {old key: new key} keys (see redrawCache).
+    """
+    with self.lock:
+      for ref, used in self.refs.values():
+        for old in [k for c, k in used if c is cache and k in keys]:
+          used.discard((cache, old))
+          u = self.users.pop((cache, old), 1) - 1
+          if u > 0:
+            self.users[cache, old] = u
+          new = (cache, keys[old])
+          if new not in used:
+            used.add(new)
+            self.users[new] = self.users.get(new, 0) + 1
+
+  def purge(self, images = True, roots = None):
+    """
+    Forget the collected objects and remove their LatexCache entries and
+    (images) the ObjCache entries no living object uses. Objects tracked
+    by id are only checked if roots are given. Returns the number of
+    removed entries.
+    """
+    n = 0
+    with self.lock:
+      while self.dead:
+        i, ref = self.dead.pop()
+        r = self.refs.get(i)
+        if r is not None and r[0] is ref:
+          n += self._forget(i, images)
+      if roots is not None:
+        ids = set(i for i, r in self.refs.items() if r[0] is None)
+        for i in ids - reachable(roots, ids):
+          n += self._forget(i, images)
+    return n
+
+  def _forget(self, i, images = True):
+    """
+    Drop the object with id i and release its entries (lock held).
+    """
+    n = 0
+    for cache, key in self.refs.pop(i)[1]:
+      u = self.users.pop((cache, key), 1) - 1
+      if u > 0:
+        self.users[cache, key] = u
+      e = cache.peek(key)
+      if e is None:
+        continue
+      if cache is LatexCache:
+        drop = e.orphan(i) # an equal object may have stored its own
+      else:
+        drop = images and u <= 0
+      if drop:
+        try:
+          del cache[key]
+          n += 1
+        except KeyError:
+          pass
+    return n
+
+  def clear(self):
+    with self.lock:
+      self.refs.clear()
+      self.users.clear()
+      del self.dead[:]
+
+Tracker = ObjTracker()
+
+# The display history: the objects without weak references which are not
+# in it count as collected (see purgeCache)
+_HISTORY = ('Out', '_', '__', '___')
+
+def purgeCache():
+  """
+  Remove the cache entries of the collected sympy objects (IPython
+  post_execute hook). Objects without weak references are looked up in
+  the display history only (not the whole user namespace), and only if
+  fs.purge is on; the images are kept if it is off.
+  """
+  roots = None
+  if gcfg.purge and _ip is not None:
+    roots = [_ip.user_ns.get(k) for k in _HISTORY]
+  Tracker.purge(gcfg.purge, roots)
+
+
+def memoSource(key, make, obj):
+  """
+  make(obj) memoized in LatexCache under key (None: not memoized).
+  """
+  e = LatexCache.get(key) if key is not None else None
+  if e is not None and e.matches(obj):
+    Stats.count('sympy', 'hit')
+    s = e.src
   else:
+    t = time.time()
+    s = make(obj)
+    Stats.add('sympy', 'latex()', time.time() - t, len(s))
+    if key is None:
+      return s
+    LatexCache[key] = LatexEntry(s, obj)
+  Tracker.track(obj, LatexCache, key)
+  return s
+
+
+def inlineSource(obj):
+  """
+  The inline LaTeX code of a sympy object for TeX0 and TeX1 (memoized).
+  """
+  return memoSource(texKey(obj, 'inline'), _inlineSource, obj)
+
+def _inlineSource(obj):
+  s = latex(obj, mode = 'inline')
+  s = s.replace('\\operatorname','')
+  s = s.replace('\\overline', '\\bar')
+  return s
+
+
+def texSource(obj, cfg = gcfg):
+  """
+  The LaTeX code of a sympy object for TeX2 (settings mode, matrix, breqn),
+  memoized in LatexCache.
+  """
+  return memoSource(texKey(obj, cfg.mode, cfg.matrix, cfg.breqn),
+                    lambda x: _texSource(x, cfg), obj)
+
+def _texSource(obj, cfg, **settings):
+  s = latex(obj, mode = '%s' % cfg.mode, **settings)
+  #s = s.replace('smallmatrix','bmatrix') #v, V, b, B, p
+  s = s.replace('\\left(\\begin{smallmatrix}',
+                '\\begin{%smatrix}' % cfg.matrix)
+  s = s.replace('\\end{smallmatrix}\\right)',
+                '\\end{%smatrix}' % cfg.matrix)
+  # breqn
+  if cfg.breqn:
+    s = s.replace('{equation*}', '{dmath*}')
+  return s
+
+
+#;;;;;;;;;;;;;;;;;;;
+# Render budget ;;;
+#;;;;;;;;;;;;;;;;;;;
+def renderCost(obj, src, cfg = gcfg):
+  """
+  Estimated cost of rendering src, the LaTeX code of obj: its length, the
+  square of its line length / 200 (one wide box and image, e.g. a long
+  series), / 100 with breqn (line breaking), plus 20 per matrix cell
+  (alignment; a matrix has a line per row).
+  """
+  n, lines, cells = len(src), 1, 0
+  if getattr(obj, 'is_Matrix', False): # not Indexed: shape raises
+    lines, cells = max(1, obj.shape[0]), obj.shape[0] * obj.shape[1]
+  w = n // lines
+  return n + w * w // (100 if cfg.breqn else 200) + 20 * cells
+
+
+def truncatedSource(obj, cost, cfg = gcfg):
+  """
+  The LaTeX code of the leading terms of the sum obj (e.g. a long series)
+  which fit into fs.budget, followed by \\cdots. None if obj is no sum.
+  """
+  if not getattr(obj, 'is_Add', False) or len(obj.args) < 2:
+    return None
+  from sympy import Add, Symbol
+  terms = obj.as_ordered_terms()
+  k = max(1, min(len(terms) - 1, len(terms) * cfg.budget // cost))
+  part = Add(*(terms[:k] + [Symbol('\\cdots')]), evaluate = False)
+  return _texSource(part, cfg, order = 'none')
+
+
+def overBudget(obj, key, src, cost, cfg = gcfg):
+  """
+  The image of a formula over fs.budget (see fs.overbudget): None, i.e.
+  IPython shows the pretty() text (text, or defer while the render threads
+  render it for the next display) or the image of its leading terms
+  (truncate).
+  """
+  if cfg.overbudget == 'defer' and Renderer.n > 0:
+    def done(job):
+      if job.objs.get(key) is not None:
+        putRender(key, job.objs[key])
+    for job in Renderer.submit([(key, src)], renderChunk, snapshot(cfg)):
+      job.then(done)
+  elif cfg.overbudget == 'truncate':
+    s = truncatedSource(obj, cost, cfg)
+    if s is None:
+      return None
+    k = renderKey(s, cfg)
+    Tracker.track(obj, ObjCache, k)
+    if k not in ObjCache and k not in FailCache:
+      repr_obj = Renderer.run([(k, s)], renderChunk, snapshot(cfg)).get(k)
+      if repr_obj is not None:
+        putRender(k, repr_obj)
+    x = ObjCache.get(k)
+    return x.png if x is not None else None
+  return None
+
+
+def print_png_batch(objs):
+  """
+  Render a list of sympy objects at once (see TeX2.render_many, in
+  fs.workers parallel chunks) and fill the cache, e.g. print_png_batch(Obj)
+  before: for obj in Obj: display(obj)
+  Returns the PNG images (SVG texts for method svg) in the same order
+  (None on errors).
+  """
+  if not gcfg._active: return [None] * len(objs)
+  if gcfg._use not in ('latex', 'svg'):
+    return [print_png(x) for x in objs]
+  svg = gcfg._use == 'svg'
+  keys, todo, over = [], {}, {}
+  for n, x in enumerate(objs):
     try:
-      s = latex(self, mode = '%s' % gcfg.mode)
-      #s = s.replace('smallmatrix','bmatrix') #v, V, b, B, p
-      s = s.replace('\\left(\\begin{smallmatrix}',
-                    '\\begin{%smatrix}' % gcfg.matrix)
-      s = s.replace('\\end{smallmatrix}\\right)',
-                    '\\end{%smatrix}' % gcfg.matrix)
-      # breqn
-      if gcfg.breqn:
-        s = s.replace('{equation*}', '{dmath*}')
-
-      repr_obj = TeX2(s)
-      putObj(self, repr_obj)
-      return repr_obj.png
+      s = texSource(x)
+      keys.append(svgKey(s) if svg else renderKey(s))
+      Tracker.track(x, ObjCache, keys[-1])
+      if keys[-1] in ObjCache or keys[-1] in FailCache:
+        continue
+      cost = renderCost(x, s)
+      if not svg and gcfg.budget and cost > gcfg.budget:
+        Stats.count('TeX2', 'overbudget')
+        over[n] = (x, keys[-1], s, cost) # see print_png2
+      else:
+        todo[keys[-1]] = s # equal formulas are rendered once
     except:
-      return None
+      keys.append(None)
+  objs = Renderer.run(todo.items(), svgChunk if svg else renderChunk,
+                      snapshot(gcfg))
+  for key, repr_obj in objs.items():
+    putRender(key, repr_obj)
+  imgs = [getattr(ObjCache[k], 'svg' if svg else 'png') if k in ObjCache
+          else None for k in keys]
+  for n, args in over.items():
+    try:
+      imgs[n] = overBudget(*args)
+    except:
+      imgs[n] = None
+  return imgs
 
 
 def print_png(obj):
@@ -645,9 +3531,184 @@ def print_png(obj):
     return print_png1(obj)
   elif gcfg._use == 'latex':
     return print_png2(obj)
+  elif gcfg._use == 'svg' and gcfg._active and print_svg(obj) is None:
+    return fallback(obj)
+  elif gcfg._use == 'auto':
+    return print_png_auto(obj)
   else:
     return None
 
+
+#;;;;;;;;;;;;;;;;;
+# Auto method ;;;
+#;;;;;;;;;;;;;;;;;
+class RenderCosts():
+  """
+  Measured render time and failures per method (for the method auto).
+  """
+
+  def __init__(self):
+    self.runs = {}
+    self.fails = {}
+    self.time = {}
+    self.lock = threading.Lock()
+
+  def record(self, method, dt, ok):
+    with self.lock:
+      self.runs[method] = self.runs.get(method, 0) + 1
+      self.fails[method] = self.fails.get(method, 0) + (not ok)
+      self.time[method] = self.time.get(method, 0.0) + dt
+
+  def cost(self, method, cfg = gcfg):
+    """
+    Expected time of a render by method: mean time / success rate
+    (fs.autoprior until fs.autominruns renders were measured).
+    """
+    with self.lock:
+      n = self.runs.get(method, 0)
+      if n < cfg.autominruns:
+        return cfg.autoprior.get(method, 1.0)
+      return self.time[method] / max(n - self.fails[method], 1)
+
+  def stats(self):
+    """
+    runs/fails/mean time per method as strings.
+    """
+    with self.lock:
+      return dict((m, '%d/%d/%.4fs' % (n, self.fails[m], self.time[m] / n))
+                  for m, n in self.runs.items())
+
+  def clear(self):
+    with self.lock:
+      self.runs.clear()
+      self.fails.clear()
+      self.time.clear()
+
+Costs = RenderCosts()
+
+# Not in mathtext: environments (matrix, cases, ...), line breaks, text
+_NEEDLATEX = re.compile(r'\\begin|\\\\|\\text|\\substack|\\boxed|\\cancel')
+
+def autoMethod(obj, cfg = gcfg):
+  """
+  The method for obj in auto mode: latex if mathtext can't render it
+  (see _NEEDLATEX, fs.automaxlen, failed before), otherwise the one with
+  the lowest cost.
+  """
+  s = inlineSource(obj)
+  if (_NEEDLATEX.search(s) or len(s) > cfg.automaxlen or
+      contentKey('mplib', s) in FailCache):
+    return 'latex'
+  return min(('mplib', 'latex'), key = lambda m: Costs.cost(m, cfg))
+
+
+def print_png_auto(obj):
+  """
+  Display sympy expression using TeX1 or TeX2 (see autoMethod).
+  """
+  if not gcfg._active: return None
+  try:
+    key = renderKey(texSource(obj))
+    if key in ObjCache or key in FailCache:
+      return print_png2(obj)
+    if autoMethod(obj) == 'mplib':
+      s = inlineSource(obj)
+      t = time.time()
+      try:
+        png = TeX1(s, cfg = gcfg).png
+      except Exception:
+        png = None
+      Costs.record('mplib', time.time() - t, png is not None)
+      if png is not None:
+        return png
+      FailCache[contentKey('mplib', s)] = ''
+    t = time.time()
+    png = print_png2(obj)
+    Costs.record('latex', time.time() - t, key in ObjCache)
+    return png
+  except:
+    return None
+
+#;;;;;;;;;;;;;;;;;;
+# Async display ;;;
+#;;;;;;;;;;;;;;;;;;
+_ip = None
+_displayids = count()
+
+def placeholder(obj, cfg = gcfg):
+  """
+  The cheap stand-in for obj while it is being rendered (mime bundle).
+  """
+  data = {'text/plain': pretty(obj, use_unicode = True)}
+  if cfg.placeholder == 'mplib':
+    try:
+      png = print_png1(obj)
+      if png:
+        data['image/png'] = png
+    except:
+      pass
+  return data
+
+
+def display_async(obj):
+  """
+  Display obj (IPython's ipython_display_formatter in async mode): cached
+  images and other methods at once, otherwise a placeholder with a
+  display id which is updated by the render thread.
+  """
+  from IPython.display import display, update_display
+  data = {'text/plain': pretty(obj, use_unicode = True)}
+  try:
+    s = texSource(obj)
+    key = renderKey(s)
+    Tracker.track(obj, ObjCache, key)
+    if gcfg.budget and renderCost(obj, s) > gcfg.budget:
+      key = None # shown by print_png2 (fs.overbudget)
+  except:
+    key = None
+  if (key is None or key in ObjCache or key in FailCache or
+      not gcfg._active or gcfg._use != 'latex' or Renderer.n == 0):
+    png = print_png(obj)
+    if png:
+      data['image/png'] = png
+    svg = print_svg(obj)
+    if svg:
+      data['image/svg+xml'] = svg
+    display(data, raw = True)
+    return
+
+  did = 'sympyprt-%d-%d' % (os.getpid(), next(_displayids))
+  display(placeholder(obj), raw = True, display_id = did)
+
+  def done(job):
+    repr_obj = job.objs.get(key)
+    if repr_obj is None:
+      return
+    putRender(key, repr_obj)
+    png = repr_obj.png or fallback(obj)
+    if png:
+      data['image/png'] = png
+      update_display(data, raw = True, display_id = did)
+
+  for job in Renderer.submit([(key, s)], renderChunk, snapshot(gcfg)):
+    job.then(done)
+
+
+def setAsync(on):
+  """
+  Turn the async mode on/off (registers display_async for sympy objects).
+  """
+  gcfg.asyncrender = on
+  if _ip is None:
+    return
+  f = _ip.display_formatter.ipython_display_formatter
+  for name in ('sympy.core.basic.Basic', 'sympy.matrices.matrices.Matrix'):
+    if on:
+      f.for_type_by_name(*(name.rsplit('.', 1) + [display_async]))
+    else:
+      f.pop(name, None)
+
+
 #;;;;;;;;;;;;;;;;;
 # IPy Extension;;;
 #;;;;;;;;;;;;;;;;;
@@ -671,6 +3732,19 @@ def load_ipython_extension(ip):
     png_formatter.for_type_by_name('sympy.matrices.matrices','Matrix', print_png)
     png_formatter.for_type_by_name('sympy.core.basic', 'Basic', print_png)
 
+    svg_formatter = ip.display_formatter.formatters['image/svg+xml']
+    svg_formatter.for_type_by_name('sympy.matrices.matrices','Matrix', print_svg)
+    svg_formatter.for_type_by_name('sympy.core.basic', 'Basic', print_svg)
+
+    try:
+      ip.events.register('post_execute', purgeCache)
+    except AttributeError:
+      ip.register_post_execute(purgeCache) # IPython < 2
+
+    global _ip
+    _ip = ip
+    setAsync(gcfg.asyncrender)
+
     gcfg._loaded = True
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+# ============================
+# sympyprt render budget check
+# ============================
+#
+# Usage:
+#   python test_sympyprt_budget.py (or collected by pytest)
+#
+# Checks that renderCost puts (1/cos(x)).series(x, 0, 50), which keeps latex
+# (and breqn) busy for seconds, over the default fs.budget with and without
+# breqn, and a short series and a 10x10 matrix within it. Needs no TeX.
+# Skipped without sympy.
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+from __future__ import print_function
+
+import sys
+
+if sys.version_info[0] >= 3:
+  import sympyprt3 as sp
+else:
+  import sympyprt as sp
+
+try:
+  import sympy
+except ImportError:
+  sympy = None
+
+
+def check():
+  """
+  The problems found (empty if the costs are on the right side of the
+  budget).
+  """
+  x = sympy.Symbol('x')
+  a = sympy.Matrix(10, 10, lambda i, j: sympy.Symbol('a%d%d' % (i, j)))
+  cases = [((1 / sympy.cos(x)).series(x, 0, 50), True),
+           ((1 / sympy.cos(x)).series(x, 0, 20), False),
+           (a, False)]
+  errors = []
+  for breqn in (False, True):
+    cfg = sp.snapshot(sp.gcfg, breqn = breqn)
+    for e, over in cases:
+      cost = sp.renderCost(e, sp._texSource(e, cfg), cfg)
+      if (cost > cfg.budget) != over:
+        errors.append('%s (breqn %s): cost %d, budget %d'
+                      % (sympy.srepr(e)[:40], breqn, cost, cfg.budget))
+  return errors
+
+
+def test_budget():
+  if sympy is None:
+    import pytest
+    pytest.skip('sympy not installed')
+  assert check() == []
+
+
+def main():
+  if sympy is None:
+    print('skipped: sympy not installed')
+    return 0
+  errors = check()
+  for e in errors:
+    print(e)
+  if not errors:
+    print('budget ok')
+  return 1 if errors else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+# ===========================
+# sympyprt import-time budget
+# ===========================
+#
+# Usage:
+#   python test_sympyprt_import.py [budget seconds, default 0.5]
+#   (or collected by pytest: test_import_budget)
+#
+# Imports sympyprt (sympyprt3 on Python 3) in fresh interpreters and fails
+# (exit status 1) if the best of 5 imports takes longer than the budget or
+# if the import loads a backend module (matplotlib, numpy, sympy, IPython),
+# which sympyprt only imports on first use. Needs none of them installed.
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+from __future__ import print_function
+
+import os, sys
+
+from subprocess import Popen, PIPE
+
+# Modules sympyprt must not import at load time
+_backendmods = ['matplotlib', 'numpy', 'sympy', 'IPython']
+
+_module = 'sympyprt3' if sys.version_info[0] >= 3 else 'sympyprt'
+_budget = 0.5
+
+
+def importTime(module = _module, n = 5):
+  """
+  Seconds to import module in a fresh interpreter (best of n, None if the
+  import failed) and the backend modules that import loaded.
+  """
+  code = ('import sys, time\nt = time.time()\nimport %s\n'
+          'print(time.time() - t)\n'
+          'print(" ".join(m for m in %r if m in sys.modules))'
+          % (module, _backendmods))
+  best, mods = None, []
+  for i in range(n):
+    p = Popen([sys.executable, '-c', code], stdout = PIPE,
+              cwd = os.path.dirname(os.path.abspath(__file__)))
+    out = p.communicate()[0].decode('utf-8').splitlines()
+    if p.returncode != 0 or not out:
+      return None, []
+    t = float(out[0])
+    best = t if best is None else min(best, t)
+    mods = out[1].split() if len(out) > 1 else []
+  return best, mods
+
+
+def check(budget = _budget, module = _module):
+  """
+  The problems of importing module (empty if it is within the budget).
+  """
+  t, mods = importTime(module)
+  if t is None:
+    return ['import %s failed' % module]
+  errors = []
+  if mods:
+    errors.append('import %s loaded %s' % (module, ' '.join(mods)))
+  if t > budget:
+    errors.append('import %s took %.1f ms (budget %.1f ms)'
+                  % (module, 1000 * t, 1000 * budget))
+  return errors
+
+
+def test_import_budget():
+  assert check() == []
+
+
+def main(argv = None):
+  args = sys.argv[1:] if argv is None else argv
+  errors = check(float(args[0]) if args else _budget)
+  for e in errors:
+    print(e)
+  if not errors:
+    print('import %s ok' % _module)
+  return 1 if errors else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+# ==============================
+# sympyprt object tracking check
+# ==============================
+#
+# Usage:
+#   python test_sympyprt_purge.py (or collected by pytest)
+#
+# Renders a sympy Add (which can't be weakly referenced) with the fake TeX
+# programs of fake_tex.py, drops it from the display history (Out, _) of a
+# stand-in IPython shell (like %reset out) and checks that the post_execute
+# purge (purgeCache) removes its LaTeX code and image: not with fs.purge
+# off, and with fs.purge on although a variable still holds it (only the
+# display history is searched). Also checks that an equal Add built anew
+# hits the LaTeX memo. Skipped without sympy.
+#;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+from __future__ import print_function
+
+import os, sys
+import shutil
+import tempfile
+import weakref
+
+if sys.version_info[0] >= 3:
+  import sympyprt3 as sp
+else:
+  import sympyprt as sp
+
+import fake_tex
+
+try:
+  import sympy
+  from sympy.core.cache import clear_cache
+except ImportError:
+  sympy = None
+
+
+class Shell:
+  """
+  Stand-in for the IPython shell (sympyprt._ip) with its user namespace.
+  """
+  def __init__(self, ns):
+    self.user_ns = ns
+
+
+def check():
+  """
+  The problems found (empty if the Add was purged).
+  """
+  x, y = sympy.symbols('x y')
+  e = sympy.Add(x, y**2)
+  try:
+    weakref.ref(e)
+    return ['sympy.Add can be weakly referenced, nothing to check']
+  except TypeError:
+    pass
+
+  tmp = tempfile.mkdtemp(prefix = 'test-sympyprt-')
+  fake_tex.install(sp.gcfg)
+  sp.gcfg.fmtdir = os.path.join(tmp, 'fmt')
+  sp.gcfg._active, sp.gcfg._use, sp.gcfg.recolor = True, 'latex', False
+  sp.gcfg.diskcache = sp.gcfg.asyncrender = False
+  sp.clearCache()
+  errors = []
+  try:
+    ns = {'Out': {1: e}, '_': e}
+    sp._ip = Shell(ns)
+    if sp.print_png2(e) is None:
+      return ['print_png2 rendered no image']
+    sp.purgeCache()
+    if len(sp.ObjCache) != 1 or len(sp.LatexCache) != 1:
+      errors.append('purged while still in the display history')
+    clear_cache() # else sympy returns e again
+    e2 = sympy.Add(x, y**2)
+    hits = sp.Stats.counts.get(('sympy', 'hit'), 0)
+    if e2 is e or sp.texSource(e2) != sp.texSource(e) or \
+       sp.Stats.counts.get(('sympy', 'hit'), 0) != hits + 2:
+      errors.append('an equal Add missed the LaTeX memo')
+    del e2
+    ns['Out'].clear() # %reset out
+    del ns['_']
+    ns['e'] = e
+    sp.gcfg.purge = False
+    sp.purgeCache()
+    if len(sp.ObjCache) != 1 or len(sp.LatexCache) != 1:
+      errors.append('purged with fs.purge off')
+    sp.gcfg.purge = True
+    sp.purgeCache()
+    if len(sp.ObjCache) or len(sp.LatexCache):
+      errors.append('not purged: %d images, %d LaTeX entries'
+                    % (len(sp.ObjCache), len(sp.LatexCache)))
+  finally:
+    sp._ip = None
+    sp.gcfg.purge = True
+    sp.stopWorkers()
+    shutil.rmtree(tmp, True)
+  return errors
+
+
+def test_purge_add():
+  if sympy is None:
+    import pytest
+    pytest.skip('sympy not installed')
+  assert check() == []
+
+
+def main():
+  if sympy is None:
+    print('skipped: sympy not installed')
+    return 0
+  errors = check()
+  for e in errors:
+    print(e)
+  if not errors:
+    print('purge ok')
+  return 1 if errors else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -17,11 +17,19 @@ __loc_id__ = "hg.scios.ch/py_site_scios_tex"
 #;;;;;;;;;;;;
 import os, os.path
 import re
+import time
+import shutil
+import tempfile
 
-from subprocess import Popen, PIPE
+from subprocess import PIPE
 from tempfile import NamedTemporaryFile
 from copy import copy
 
+# Format files, process handling, disk cache, statistics and svg colors
+# of sympyprt
+from sympyprt import (splitDocument, formatFile, dropFormat, _FMTERR,
+  spawn, communicate, getDiskCache, contentKey, Stats, svgStyle)
+
 
 #;;;;;;;;;;;;;;;;;;;;;
 # Factory settings ;;;
@@ -34,6 +42,11 @@ fs._params = []
 
 fs.latex = 'latex'
 fs.dvipng = 'dvipng'
+fs.dvisvgm = 'dvisvgm'
+
+# Output format: png (dvipng) or svg (dvisvgm, scalable, glyphs are
+# defined once per image and reused)
+fs.output = 'png'
 
 fs.fontsize = 12
 fs.resolution = 150
@@ -56,6 +69,7 @@ fs.preamble = r'''\documentclass[%ipt]{article}
 
 fs.latexcmd = r"{0} -halt-on-error"
 fs.dvipngcmd = r"{0} -T {1} -D {2:d} -bg {3} -fg {4} -O {5} -o {6} {7}"
+fs.dvisvgmcmd = r"{0} --no-fonts --exact --stdout {1}"
 
 fs.jobname = 'texput'
 fs.dvifile = fs.jobname + '.dvi'
@@ -63,8 +77,35 @@ fs.pngfile = fs.jobname + '.png'
 
 fs.exts = ['dvi','aux','png','log'] # removed
 
+# Each render runs in its own scratch directory below scratchdir (tmpfs
+# if available, None => system temp dir), removed by cleanup
+fs.scratchdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 fs.errdvipng = 'Error (dvipng): use the log property for more information.'
 fs.errlatex = 'Error (latex): use the log property for more information.'
+fs.errdvisvgm = 'Error (dvisvgm): use the log property for more information.'
+
+# Precompiled format files: the preamble (up to \begin{document}) of each
+# distinct preamble/fontsize is dumped once into fs.fmtdir and latex is
+# started with -fmt (sympyprt.formatFile). The file name is a hash of the
+# preamble text.
+# fs.fmtdir must be private (owned by the user, mode 0700), formats are
+# not used otherwise.
+fs.fmt = True
+fs.fmtbase = 'latex'
+fs.fmtdir = os.path.join(os.environ.get('XDG_CACHE_HOME',
+  os.path.join(os.path.expanduser('~'), '.cache')), 'texprt', 'fmt')
+fs.fmtcmd = r'{0} -ini -interaction=nonstopmode -jobname={1} "&{2}" {1}.tex'
+fs.fmtopt = r' -fmt="{0}"'
+
+# latex, dvipng and dvisvgm runs are killed (with their process group, see
+# sympyprt.spawn) after rendertimeout seconds (0: never)
+fs.rendertimeout = 30
+
+# On-disk PNG cache shared with sympyprt, None =>
+# sympyprt's fs.diskcachedir
+fs.diskcache = False
+fs.diskcachedir = None
 
 #;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
 # Cache + manipulation functions ;;;
@@ -76,13 +117,39 @@ def hasObj(x): return ObjCache.has_key(id(x))
 def getPNG(x): return getObj(x).png
 def clearCache(): ObjCache.clear()
 
+def diskCache(cfg):
+  """
+  The sympyprt.DiskCache for cfg or None (off).
+  """
+  if not cfg.diskcache:
+    return None
+  return getDiskCache(cfg.diskcachedir)
+
+def diskKey(src, cfg):
+  """
+  Key of the image of src in the disk cache.
+  """
+  if cfg.output == 'svg':
+    return contentKey('texprt-svg', src, cfg.preamble, cfg.fontsize,
+      cfg.backcolor, cfg.forecolor)
+  return contentKey('texprt', src, cfg.preamble, cfg.fontsize, cfg.resolution,
+    cfg.imagesize, cfg.backcolor, cfg.forecolor, cfg.offset)
+
+def record(stage, t0, nbytes = None):
+  """
+  Add the time since t0 (and nbytes) for stage to the render statistics
+  of sympyprt (%sympyprt stats).
+  """
+  Stats.add('texprt', stage, time.time() - t0, nbytes)
+
 
 #;;;;;;;;;;;;;;
 # Class TeX ;;;
 #;;;;;;;;;;;;;;
 class TeX():
   """
-  Convert TeX code to a PNG image via dvi using the 'dvipng' command.
+  Convert TeX code to a PNG image via dvi using the 'dvipng' command
+  (or to SVG using 'dvisvgm' if fs.output is 'svg').
   Credit: dvipng 1.XX Copyright 2002-2008 Jan-Ake Larsson
   Details: http://www.nongnu.org/dvipng/dvipng_4.html
   -- This is by far the shortest and fastest version (compared to TeX2).
@@ -105,9 +172,19 @@ class TeX():
     # The PNG file
     self.pngfile = None
 
+    # The scratch directory (while rendering)
+    self.dir = None
+
+    # The dvi of the last latex run and its document (see render)
+    self.dvi = None
+    self.dvidoc = None
+
     # The PNG image (string/x89PNG)
     self.png = None
 
+    # The SVG image (text, fs.output = 'svg')
+    self.svg = None
+
     # Render now or later?
     if cfg.initrender:
       self.render(self.cfg)
@@ -118,9 +195,25 @@ class TeX():
     Run latex then convert the dvi output to png. The mandatory cfg
     has to be an instance of fs (usually self.cfg).
     """
+    t0 = time.time()
+
     # Default template
     self.preamble = cfg.preamble % (cfg.fontsize, self.src)
 
+    # On-disk cache
+    disk = diskCache(cfg)
+    ext = '.' + cfg.output
+    if disk is not None:
+      img = disk.get(diskKey(self.src, cfg), ext)
+      if img is not None:
+        setattr(self, cfg.output, img)
+        record('disk', t0, len(img))
+        return
+
+    # Private working directory
+    self.cleanup()
+    self.dir = tempfile.mkdtemp(prefix = 'texprt-', dir = cfg.scratchdir)
+
     # LaTeX command
     self.latex = cfg.latexcmd.format(cfg.latex)
 
@@ -129,24 +222,29 @@ class TeX():
       cfg.resolution, cfg.backcolor, cfg.forecolor, cfg.offset,
       cfg.pngfile, cfg.dvifile)
 
-    # Note: going to write to latex's stdin => needs to be piped
-    p = Popen(self.latex, shell = True, stdin = PIPE, stdout = PIPE)
-
-    # Send input & read stdout/stderr
-    log = p.communicate(cfg.preamble % (cfg.fontsize, self.src))
+    # Same document as last time (e.g. change_colors) => dvipng only
+    if self.dvi is not None and self.dvidoc == self.preamble:
+      f = open(os.path.join(self.dir, cfg.dvifile), 'wb')
+      f.write(self.dvi)
+      f.close()
+    elif not self.typeset(cfg):
+      return
 
-    # Check for errors (<>0)
-    if  p.returncode != 0:
-      print cfg.errlatex
-      self.log = log
-      self.cleanup()
+    if cfg.output == 'svg':
+      self.convert_svg(cfg)
+      if disk is not None and self.svg is not None:
+        disk.put(diskKey(self.src, cfg), self.svg, ext)
+      if self.svg is not None:
+        record('total', t0, len(self.svg))
       return
 
     # Run the dvi to png conversion
-    p = Popen(self.dvipng, shell = True, stdout = PIPE)
+    t = time.time()
+    p = spawn(self.dvipng, stdout = PIPE, cwd = self.dir)
 
     # Read stdout/stderr
-    log = p.communicate()
+    log = communicate(p, None, cfg.rendertimeout)
+    record('dvipng', t)
 
     # Check for errors (<>0)
     if p.returncode != 0:
@@ -156,26 +254,98 @@ class TeX():
       return
 
     # Set the png image path
-    self.pngfile = cfg.pngfile
+    self.pngfile = os.path.join(self.dir, cfg.pngfile)
 
     # Read and store the PNG image (use binary read)
+    t = time.time()
     f = open(self.pngfile, 'rb')
     self.png = f.read()
     f.close()
+    record('read', t)
 
     # Remove all output files
+    t = time.time()
+    self.cleanup()
+    record('cleanup', t)
+
+    if disk is not None:
+      disk.put(diskKey(self.src, cfg), self.png)
+    record('total', t0, len(self.png))
+
+
+  def typeset(self, cfg):
+    """
+    Run latex (writes cfg.dvifile into the scratch directory). Returns
+    False on errors (see the log property).
+    """
+    # Precompiled preamble (format file) if available
+    t = time.time()
+    fmt = formatFile(cfg)
+
+    # Note: going to write to latex's stdin => needs to be piped
+    if fmt:
+      p = spawn(self.latex + cfg.fmtopt.format(fmt),
+                stdin = PIPE, stdout = PIPE, cwd = self.dir)
+      log = communicate(p, splitDocument(cfg, self.src)[1],
+                        cfg.rendertimeout)
+
+      # A stale format (e.g. TeX was updated) => drop it, no preamble
+      if p.returncode != 0 and _FMTERR.search(log[0] or ''):
+        dropFormat(fmt)
+        fmt = None
+
+    if not fmt:
+      p = spawn(self.latex, stdin = PIPE, stdout = PIPE, cwd = self.dir)
+
+      # Send input & read stdout/stderr
+      log = communicate(p, self.preamble, cfg.rendertimeout)
+
+    # Check for errors (<>0)
+    if  p.returncode != 0:
+      print cfg.errlatex
+      self.log = log
+      self.cleanup()
+      return False
+
+    record('latex', t)
+
+    # Keep the dvi for redraws with other dvipng settings
+    f = open(os.path.join(self.dir, cfg.dvifile), 'rb')
+    self.dvi = f.read()
+    f.close()
+    self.dvidoc = self.preamble
+    return True
+
+
+  def convert_svg(self, cfg):
+    """
+    Convert the dvi in the scratch directory to svg (self.svg).
+    """
+    t = time.time()
+    p = spawn(cfg.dvisvgmcmd.format(cfg.dvisvgm, cfg.dvifile),
+              stdout = PIPE, stderr = PIPE, cwd = self.dir)
+
+    # Read stdout/stderr
+    log = communicate(p, None, cfg.rendertimeout)
+    record('dvisvgm', t)
+
+    # Check for errors (<>0)
+    if p.returncode != 0 or '</svg>' not in log[0]:
+      print cfg.errdvisvgm
+      self.log = log
+    else:
+      self.svg = svgStyle(log[0], cfg)
     self.cleanup()
 
 
   def cleanup(self):
     """
-    Remove all fs.jobname{fs.exts} files and reset pngfile to None.
+    Remove the scratch directory (all fs.jobname{fs.exts} files) and reset
+    pngfile to None.
     """
-    try:
-      for f in map(lambda x: self.cfg.jobname + '.' + x, self.cfg.exts):
-        os.remove(f)
-    except:
-      pass
+    if self.dir is not None:
+      shutil.rmtree(self.dir, True)
+      self.dir = None
     self.pngfile = None
 
 
@@ -205,6 +375,19 @@ class TeX():
       return False
 
 
+  def save_svg(self, filename):
+    """
+    Save the SVG image to filename.
+    """
+    try:
+      f = open(filename, 'w')
+      f.write(self.svg)
+      f.close()
+      return True
+    except:
+      return False
+
+
   def change_src(self, src, redraw = False):
     """
     Change the src input string (use raw string).
@@ -260,6 +443,13 @@ class TeX():
     return self.png
 
 
+  def _repr_svg_(self):
+    """
+    Representation as svg image (fs.output = 'svg').
+    """
+    return self.svg
+
+
 
 
 